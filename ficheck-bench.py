@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+"""
+
+    Author: Jim Clausing <jclausing@isc.sans.edu>
+
+    Date: 2026-10-18
+    Version: 0.1.0
+
+    Microbenchmarks for ficheck.py
+
+    usage: ficheck-bench.py [-h] [-V] [-o JSON] {exclusions,digests,compare,tree} ...
+
+    Each subcommand prints a small table and, with -o, also writes the
+    results as JSON so runs before and after a change can be diffed.
+
+      exclusions   lookup cost of the old Exclusion list vs. ficheck.Exclusions
+                   as the number of exclusions grows
+      digests      MB/s of each digest ficheck.py can use on this host
+      compare      diff engine and report rendering on synthetic dbs, without
+                   walking or hashing anything
+      tree         end to end runs of ficheck.py against a synthetic tree in a
+                   temp dir: initial scan, report after changes, and update,
+                   with wall/CPU time and peak RSS of each run
+
+    Everything runs as an ordinary user; the tree subcommand points ficheck.py
+    at its own db and report files with --db, --new-db and --report-file.
+
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# pylint: disable=wrong-import-position
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ficheck  # pylint: disable=import-error
+
+__version_info__ = (0, 1, 0)
+__version__ = ".".join(map(str, __version_info__))
+
+
+def timed_lookups(container, probes):
+    """Return nanoseconds per membership test of probes in container"""
+
+    start = time.perf_counter_ns()
+    for path in probes:
+        _ = path in container
+    return (time.perf_counter_ns() - start) / len(probes)
+
+
+def bench_exclusions(opts):
+    """Time exclusion matching as the exclusion count grows"""
+
+    probes = [f"/usr/lib/pkg{i % 500}/file{i}.so" for i in range(opts.probes)]
+    results = []
+    print(f"{'exclusions':>10} {'list ns/op':>12} {'compiled ns/op':>15}")
+    for count in opts.counts:
+        paths = []
+        for i in range(count):
+            if i % 5 == 4:
+                paths.append(f"/etc/noise/pkg{i}/*.dpkg-old")
+            else:
+                paths.append(f"/etc/noise/pkg{i}/state")
+        exact = [p for p in paths if '*' not in p]
+        list_ns = timed_lookups(exact, probes)
+        compiled_ns = timed_lookups(ficheck.Exclusions(paths), probes)
+        print(f"{count:>10} {list_ns:>12.0f} {compiled_ns:>15.0f}")
+        results.append({"exclusions": count, "list_ns": list_ns, "compiled_ns": compiled_ns})
+    return results
+
+
+def bench_digests(opts):
+    """Hash the same buffer with each available digest, 64 KiB at a time"""
+
+    data = os.urandom(opts.size * 1048576)
+    view = memoryview(data)
+    results = []
+    print(f"{'digest':>10} {'MB/s':>10}")
+    for name, factory in ficheck.DIGESTS.items():
+        best = None
+        for _ in range(opts.repeat):
+            start = time.perf_counter()
+            digest = factory()
+            for offset in range(0, len(data), 65536):
+                digest.update(view[offset:offset + 65536])
+            digest.hexdigest()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        rate = opts.size / best
+        print(f"{name:>10} {rate:>10.1f}")
+        results.append({"digest": name, "mb_per_s": rate})
+    return results
+
+
+def write_synthetic_db(path, rows, per_dir, skip, bump):
+    """Write a db of rows entries in walker order
+
+    Entries where skip(i) is true are left out and those where bump(i) is
+    true get a different hash, so two calls make a pair of dbs to diff.
+    """
+
+    writer = ficheck.DbWriter(path, 1048576)
+    writer.comment(f"# - - Digest   {ficheck.DEFAULT_DIGEST}")
+    writer.begin_directory("/bench")
+    dirs = (rows + per_dir - 1) // per_dir
+    for d in range(dirs):
+        writer.row([f"/bench/d{d:06d}", d + 1, "drwxr-xr-x", 2, 0, 0, 4096,
+                    " 1700000000", " 1700000000", 0, "Dir"])
+    for d in range(dirs):
+        for f in range(per_dir):
+            i = d * per_dir + f
+            if i >= rows or skip(i):
+                continue
+            digest = f"{(i * 2654435761 + bump(i)) % 2 ** 256:064x}"
+            writer.row([f"/bench/d{d:06d}/f{f:06d}", 100000 + i, "-rw-r--r--", 1, 0, 0, i,
+                        " 1700000000", " 1700000000", 0, digest])
+    writer.end_directories()
+    writer.close()
+
+
+def time_renderer(name, old_path, new_path):
+    """Diff old_path against new_path through renderer name, return (changes, seconds)"""
+
+    with open(os.devnull, 'w', encoding='utf8') as out:
+        start = time.perf_counter()
+        renderer = ficheck.RENDERERS[name](out)
+        renderer.begin()
+        count = 0
+        for item in ficheck.diff_dbs(old_path, new_path):
+            count += item.kind != 'section'
+            renderer.change(item)
+        renderer.end()
+    return count, time.perf_counter() - start
+
+
+def bench_compare(opts):
+    """Diff two synthetic dbs and render the result"""
+
+    ficheck.args = argparse.Namespace(config="ficheck-bench")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        old_path = os.path.join(tmp, "old.db")
+        new_path = os.path.join(tmp, "new.db")
+        every = max(1, int(100 / opts.change_pct)) if opts.change_pct else 0
+        write_synthetic_db(old_path, opts.rows, opts.per_dir,
+                           lambda i: every and i % every == 1, lambda i: 0)
+        write_synthetic_db(new_path, opts.rows, opts.per_dir,
+                           lambda i: every and i % every == 2,
+                           lambda i: 1 if every and i % every == 3 else 0)
+        print(f"{'renderer':>10} {'rows/s':>12} {'changes':>10} {'seconds':>9}")
+        for name in opts.renderers:
+            count, elapsed = time_renderer(name, old_path, new_path)
+            rate = opts.rows / elapsed
+            print(f"{name:>10} {rate:>12.0f} {count:>10} {elapsed:>9.2f}")
+            results.append({"renderer": name, "rows": opts.rows, "changes": count,
+                            "seconds": elapsed, "rows_per_s": rate})
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"peak RSS {peak / 1024:.1f} MB")
+    for result in results:
+        result["peak_rss_kb"] = peak
+    return results
+
+
+def parse_sizes(text):
+    """Parse a size distribution like 0:5,1K:60,64K:30,4M:5 into (sizes, weights)"""
+
+    units = {'': 1, 'K': 1024, 'M': 1048576, 'G': 1073741824}
+    sizes = []
+    weights = []
+    for item in text.split(','):
+        size, _, weight = item.partition(':')
+        size = size.strip().upper()
+        number = size.rstrip('KMG')
+        sizes.append(int(float(number) * units[size[len(number):]]))
+        weights.append(float(weight or 1))
+    return sizes, weights
+
+
+def make_dirs(top, depth, fanout):
+    """Create fanout subdirectories per level, depth levels under top, and list them all"""
+
+    dirs = [top]
+    level = [top]
+    for _ in range(depth):
+        level = [os.path.join(parent, f"d{i:03d}") for parent in level for i in range(fanout)]
+        dirs.extend(level)
+    for path in dirs[1:]:
+        os.makedirs(path, exist_ok=True)
+    return dirs
+
+
+def write_sized(path, size, block):
+    """Write size bytes to path, repeating block as needed"""
+
+    with open(path, 'wb') as out:
+        for offset in range(0, size, len(block)):
+            out.write(block[:min(len(block), size - offset)])
+
+
+def make_tree(top, opts, rng):
+    """Create a synthetic tree under top and return (files, bytes, dirs)
+
+    Files are spread over directories opts.fanout wide and opts.depth deep,
+    with sizes drawn from opts.sizes. A share of entries are symlinks or
+    FIFOs instead; FIFOs stand in for device nodes, which need root to create
+    but take the same "Device" path through process_entry().
+    """
+
+    sizes, weights = parse_sizes(opts.sizes)
+    dirs = make_dirs(top, opts.depth, opts.fanout)
+    block = os.urandom(1048576)
+    files = []
+    total = 0
+    for i in range(opts.files):
+        parent = dirs[i % len(dirs)]
+        path = os.path.join(parent, f"f{i:07d}")
+        kind = rng.random() * 100
+        if kind < opts.symlink_pct and files:
+            os.symlink(rng.choice(files), path)
+        elif kind < opts.symlink_pct + opts.fifo_pct:
+            os.mkfifo(path)
+        else:
+            size = rng.choices(sizes, weights)[0]
+            write_sized(path, size, block)
+            files.append(path)
+            total += size
+    return files, total, len(dirs)
+
+
+def write_config(path, top, exclusions, rng):
+    """Write a ficheck config for top with the given number of Exclusions"""
+
+    with open(path, 'w', encoding='utf8') as cfg:
+        print(f"Directory = {top}/", file=cfg)
+        for i in range(exclusions):
+            # a mix of plain paths and globs, almost none of which match
+            if i % 5 == 4:
+                print(f"Exclusion = {top}/d{rng.randrange(1000):03d}/*.tmp{i}", file=cfg)
+            else:
+                print(f"Exclusion = {top}/missing/pkg{i}/state", file=cfg)
+
+
+def run_ficheck(command):
+    """Run ficheck.py and return its exit status, wall time and rusage"""
+
+    start = time.perf_counter()
+    with subprocess.Popen(command, stdout=subprocess.DEVNULL) as proc:
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, time.perf_counter() - start, usage
+
+
+def touch_files(files, pct, rng):
+    """Append a byte to pct percent of files, at least one"""
+
+    for path in rng.sample(files, max(1, int(len(files) * pct / 100))):
+        with open(path, 'ab') as changed:
+            changed.write(b"x")
+
+
+def run_phase(name, command, stats_file):
+    """Run one ficheck.py phase, print its table row and return its results"""
+
+    status, elapsed, usage = run_ficheck(command)
+    with open(stats_file, encoding='utf8') as stats_fd:
+        stats = json.load(stats_fd)
+    cpu = usage.ru_utime + usage.ru_stime
+    rate = stats["entries_scanned"] / elapsed
+    megabytes = stats["bytes_hashed"] / 1048576 / elapsed
+    print(f"{name:>8} {elapsed:>9.2f} {cpu:>8.2f} {rate:>10.0f} {megabytes:>8.1f} "
+          f"{usage.ru_maxrss / 1024:>8.1f}")
+    return {"phase": name, "exit_status": status, "seconds": elapsed,
+            "cpu_seconds": cpu, "peak_rss_kb": usage.ru_maxrss,
+            "entries_per_s": rate, "mb_per_s": megabytes, "stats": stats}
+
+
+def bench_tree(opts):
+    """Scan, change, report and update a synthetic tree with ficheck.py"""
+
+    rng = random.Random(opts.seed)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ficheck.py")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        top = os.path.join(tmp, "tree")
+        os.mkdir(top)
+        files, total, dirs = make_tree(top, opts, rng)
+        config = os.path.join(tmp, "bench.cfg")
+        write_config(config, top, opts.exclusions, rng)
+        stats_file = os.path.join(tmp, "stats.json")
+        command = [sys.executable, script, '-c', config,
+                   '--db', os.path.join(tmp, "ficheck.db"),
+                   '--new-db', os.path.join(tmp, "ficheck.db.new"),
+                   '--report-file', os.path.join(tmp, "ficheck.txt"),
+                   '--stats', '--stats-file', stats_file] + opts.ficheck_args
+        print(f"{opts.files} entries, {total / 1048576:.1f} MB in {dirs} directories")
+        print(f"{'phase':>8} {'seconds':>9} {'cpu':>8} {'entries/s':>10} {'MB/s':>8} "
+              f"{'peak MB':>8}")
+        for name, extra in (("scan", ['-u']), ("report", ['-r']), ("update", ['-u', '-r'])):
+            if name == "report":
+                touch_files(files, opts.change_pct, rng)
+            results.append(run_phase(name, command + extra, stats_file))
+    return {"files": opts.files, "bytes": total, "directories": dirs, "depth": opts.depth,
+            "fanout": opts.fanout, "sizes": opts.sizes, "symlink_pct": opts.symlink_pct,
+            "fifo_pct": opts.fifo_pct, "exclusions": opts.exclusions,
+            "change_pct": opts.change_pct, "seed": opts.seed,
+            "ficheck_args": opts.ficheck_args, "phases": results}
+
+
+def main():
+    """Parse the command line, run the chosen benchmark and write the JSON results"""
+
+    parser = argparse.ArgumentParser(description="Benchmarks for ficheck.py.")
+    parser.add_argument(
+        "-V",
+        "--version",
+        action="version",
+        help="print version number",
+        version=f"%(prog)s v{__version__}"
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        metavar="JSON",
+        help="also write results to JSON file"
+    )
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    excl = subparsers.add_parser('exclusions', help="exclusion matching cost")
+    excl.add_argument(
+        '--counts',
+        type=int,
+        nargs='+',
+        default=[10, 100, 1000, 10000],
+        help="exclusion counts to try (default = 10 100 1000 10000)"
+    )
+    excl.add_argument(
+        '--probes',
+        type=int,
+        default=20000,
+        help="paths looked up per count (default = 20000)"
+    )
+    excl.set_defaults(func=bench_exclusions)
+
+    dig = subparsers.add_parser('digests', help="digest throughput")
+    dig.add_argument(
+        '--size',
+        type=int,
+        default=256,
+        help="MB hashed per run (default = 256)"
+    )
+    dig.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help="runs per digest, best is reported (default = 3)"
+    )
+    dig.set_defaults(func=bench_digests)
+
+    cmp = subparsers.add_parser('compare', help="diff engine throughput")
+    cmp.add_argument(
+        '--rows',
+        type=int,
+        default=1000000,
+        help="entries per db (default = 1000000)"
+    )
+    cmp.add_argument(
+        '--per-dir',
+        type=int,
+        default=1000,
+        help="files per synthetic directory (default = 1000)"
+    )
+    cmp.add_argument(
+        '--change-pct',
+        type=float,
+        default=1.0,
+        help="percent of entries added, deleted and modified (default = 1)"
+    )
+    cmp.add_argument(
+        '--renderers',
+        nargs='+',
+        default=['text', 'json', 'csv'],
+        help="report formats to time (default = text json csv)"
+    )
+    cmp.set_defaults(func=bench_compare)
+
+    tree = subparsers.add_parser('tree', help="end to end runs on a synthetic tree")
+    tree.add_argument(
+        '--files',
+        type=int,
+        default=10000,
+        help="entries in the tree (default = 10000)"
+    )
+    tree.add_argument(
+        '--sizes',
+        default="0:5,512:50,8K:35,128K:9,2M:1",
+        help="file size distribution as SIZE:WEIGHT,... (default = 0:5,512:50,8K:35,128K:9,2M:1)"
+    )
+    tree.add_argument(
+        '--depth',
+        type=int,
+        default=3,
+        help="directory levels below the top (default = 3)"
+    )
+    tree.add_argument(
+        '--fanout',
+        type=int,
+        default=8,
+        help="subdirectories per directory (default = 8)"
+    )
+    tree.add_argument(
+        '--symlink-pct',
+        type=float,
+        default=5.0,
+        help="percent of entries that are symlinks (default = 5)"
+    )
+    tree.add_argument(
+        '--fifo-pct',
+        type=float,
+        default=1.0,
+        help="percent of entries that are FIFOs (default = 1)"
+    )
+    tree.add_argument(
+        '--exclusions',
+        type=int,
+        default=100,
+        help="Exclusion lines in the generated config (default = 100)"
+    )
+    tree.add_argument(
+        '--change-pct',
+        type=float,
+        default=1.0,
+        help="percent of files appended to before the report run (default = 1)"
+    )
+    tree.add_argument(
+        '--seed',
+        type=int,
+        default=1,
+        help="random seed for the tree and the changes (default = 1)"
+    )
+    tree.add_argument(
+        'ficheck_args',
+        nargs=argparse.REMAINDER,
+        help="extra ficheck.py arguments, after --"
+    )
+    tree.set_defaults(func=bench_tree)
+
+    opts = parser.parse_args()
+    if opts.bench == 'tree' and opts.ficheck_args[:1] == ['--']:
+        opts.ficheck_args = opts.ficheck_args[1:]
+    output = {"bench": opts.bench, "results": opts.func(opts)}
+    if opts.output:
+        with open(opts.output, 'w', encoding='utf8') as out:
+            json.dump(output, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
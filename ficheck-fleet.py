@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+
+    Author: Jim Clausing <jclausing@isc.sans.edu>
+
+    Date: 2026-10-18
+    Version: 0.1.0
+
+    Compare the ficheck.py dbs of many identically-built hosts
+
+    usage: ficheck-fleet.py [-h] [-V] [-m FIELDS] [-q PCT] [--format {text,json}]
+                            [-t DIR] [--no-presence] DB [DB ...]
+
+    Every db is read as a stream sorted by path (binary dbs through their
+    path index, text dbs after sorting them into a pickled spool file one
+    at a time), and the streams are merged, so only one row per host is held
+    at once. For each path, the hosts that disagree with the majority are
+    reported, along with paths missing from, or only present on, a
+    minority of hosts. Exits 1 if anything was reported.
+
+    positional arguments:
+      DB                    ficheck dbs, text or binary, one per host
+
+    options:
+      -h, --help            show this help message and exit
+      -V, --version         print version number
+      -m FIELDS, --mask FIELDS
+                            fields not compared (default =
+                            inode,links,ctime,mtime,btime)
+      -q PCT, --quorum PCT  percent of the hosts with a path that must agree
+                            before the rest are called outliers (default = 50)
+      --format {text,json}  output format (default = text)
+      -t DIR, --tmpdir DIR  where text dbs are spooled while sorting
+      --no-presence         don't report paths missing from some hosts
+
+"""
+
+import argparse
+import heapq
+import json
+import mmap
+import os
+import pickle
+import sys
+import tempfile
+from collections import Counter
+
+# pylint: disable=wrong-import-position
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ficheck  # pylint: disable=import-error
+
+__version_info__ = (0, 1, 0)
+__version__ = ".".join(map(str, __version_info__))
+
+FIELD_LABELS = {idx: name for name, idx in ficheck.MASK_FIELDS.items()}
+
+
+SPOOL_CHUNK = 4096
+
+
+def binary_rows(db_path, host, fields):
+    """Yield (path, host, compared fields) for a binary db in path order"""
+
+    with open(db_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        last = None
+        for row in ficheck.BinaryDb(data).sorted_rows():
+            if row[0] != last:
+                last = row[0]
+                yield row[0], host, "\0".join(row[idx].strip() for idx in fields)
+
+
+def text_rows(db_path, host, fields, spool_dir):
+    """Yield (path, host, compared fields) for a text db in path order
+
+    The db is sorted in memory and pickled to a temp file in chunks straight
+    away, so only one text db is ever held in memory; the chunks are read
+    back as the merge asks for rows.
+    """
+
+    rows = sorted((line[0], host, "\0".join(line[idx].strip() for idx in fields))
+                  for line in ficheck.read_db(db_path) if len(line) == 11)
+    # pylint: disable=consider-using-with
+    spool = tempfile.TemporaryFile(dir=spool_dir)
+    chunk = []
+    last = None
+    for row in rows:
+        if row[0] != last:
+            last = row[0]
+            chunk.append(row)
+            if len(chunk) == SPOOL_CHUNK:
+                pickle.dump(chunk, spool, pickle.HIGHEST_PROTOCOL)
+                chunk = []
+    if chunk:
+        pickle.dump(chunk, spool, pickle.HIGHEST_PROTOCOL)
+    del rows, chunk
+    spool.seek(0)
+
+    def replay():
+        with spool:
+            while True:
+                try:
+                    yield from pickle.load(spool)
+                except EOFError:
+                    return
+
+    return replay()
+
+
+def path_groups(host_streams):
+    """Merge host streams and yield (path, {host: values}) in path order
+
+    A path can be in two sections of one db when Directory roots overlap;
+    the streams only carry it once.
+    """
+
+    group = {}
+    current = None
+    for path, host, values in heapq.merge(*host_streams):
+        if path != current:
+            if group:
+                yield current, group
+            current, group = path, {}
+        group[host] = values
+    if group:
+        yield current, group
+
+
+def outliers(path, group, names, fields, opts):
+    """Return the findings for one path as a list of dicts"""
+
+    findings = []
+    if len(group) == len(names) and len(set(group.values())) == 1:
+        return findings
+    counts = Counter(group.values())
+    majority, agree = counts.most_common(1)[0]
+    if len(counts) > 1 and agree * 100 >= opts.quorum * len(group):
+        for values, _ in counts.most_common()[1:]:
+            differ = [names[host] for host, host_values in group.items() if host_values == values]
+            findings.append({
+                "path": path, "kind": "differs", "hosts": sorted(differ),
+                "agree": agree, "present": len(group),
+                "fields": {FIELD_LABELS[idx]: [expected, actual]
+                           for idx, expected, actual
+                           in zip(fields, majority.split("\0"), values.split("\0"))
+                           if expected != actual}})
+    if not opts.no_presence and len(group) < len(names):
+        if len(group) * 100 >= opts.quorum * len(names):
+            missing = sorted(name for host, name in enumerate(names) if host not in group)
+            findings.append({"path": path, "kind": "missing", "hosts": missing,
+                             "present": len(group)})
+        else:
+            findings.append({"path": path, "kind": "only",
+                             "hosts": sorted(names[host] for host in group),
+                             "present": len(group)})
+    return findings
+
+
+def print_finding(finding, total):
+    """Print one finding as a line of text"""
+
+    hosts = ", ".join(finding["hosts"])
+    if finding["kind"] == "differs":
+        texts = ", ".join(f"{name}: {values[1]} (majority {values[0]})"
+                          for name, values in finding["fields"].items())
+        print(f"{finding['path']}: differs on {hosts} [{texts}], "
+              f"{finding['agree']} of {finding['present']} hosts agree")
+    elif finding["kind"] == "missing":
+        print(f"{finding['path']}: missing on {hosts}, "
+              f"present on {finding['present']} of {total} hosts")
+    else:
+        print(f"{finding['path']}: only on {hosts}")
+
+
+def host_name(db_path, names):
+    """Name a db by its Host header, or its file name if that is taken"""
+
+    host = ficheck.db_header(db_path).get('Host') or os.path.basename(db_path)
+    if host in names:
+        host = db_path
+    return host
+
+
+def main():
+    """Parse the command line, compare the dbs and exit 1 if anything was found"""
+
+    parser = argparse.ArgumentParser(description="Compare the ficheck dbs of many hosts.")
+    parser.add_argument(
+        "-V",
+        "--version",
+        action="version",
+        help="print version number",
+        version=f"%(prog)s v{__version__}"
+    )
+    parser.add_argument(
+        '-m',
+        '--mask',
+        metavar="FIELDS",
+        default="inode,links,ctime,mtime,btime",
+        help="fields not compared (default = inode,links,ctime,mtime,btime)"
+    )
+    parser.add_argument(
+        '-q',
+        '--quorum',
+        metavar="PCT",
+        type=float,
+        default=50,
+        help="percent of the hosts with a path that must agree before the rest are called "
+        "outliers (default = 50)"
+    )
+    parser.add_argument(
+        '--format',
+        choices=['text', 'json'],
+        default='text',
+        help="output format (default = text)"
+    )
+    parser.add_argument(
+        '-t',
+        '--tmpdir',
+        metavar="DIR",
+        help="where text dbs are spooled while sorting"
+    )
+    parser.add_argument(
+        '--no-presence',
+        action='store_true',
+        default=False,
+        help="don't report paths missing from some hosts"
+    )
+    parser.add_argument(
+        'dbs',
+        metavar="DB",
+        nargs='+',
+        help="ficheck dbs, text or binary, one per host"
+    )
+    args = parser.parse_args()
+    try:
+        masked = ficheck.parse_field_mask(args.mask)
+    except ValueError as err:
+        parser.error(str(err))
+    compared = tuple(idx for idx in range(1, 11) if idx not in masked)
+
+    hosts = []
+    streams = []
+    for db in args.dbs:
+        hosts.append(host_name(db, hosts))
+        if ficheck.is_binary_db(db):
+            streams.append(binary_rows(db, len(hosts) - 1, compared))
+        else:
+            streams.append(text_rows(db, len(hosts) - 1, compared, args.tmpdir))
+
+    found = 0
+    for file_path, by_host in path_groups(streams):
+        for item in outliers(file_path, by_host, hosts, compared, args):
+            found += 1
+            if args.format == 'json':
+                print(json.dumps(item))
+            else:
+                print_finding(item, len(hosts))
+    sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
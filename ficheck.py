@@ -3,15 +3,36 @@
 
     Author: Jim Clausing <jclausing@isc.sans.edu>
 
-    Date: 2026-05-07
-    Version: 1.0.3
+    Date: 2026-10-18
+    Version: 1.21.0
 
     Perform file integrity check on Unix/Linux systems
 
     Based loosely on the fcheck Perl script by Michael A. Gumienny
 
     
-    usage: ficheck.py [-h] [-c CONFIG] [-u] [-V] [-r]
+    usage: ficheck.py [-h] [-c CONFIG] [-s SIZE] [-u] [--db PATH]
+                      [--new-db PATH] [--report-file PATH] [-V] [-r] [-i]
+                      [--rehash-days DAYS] [--sample PCT] [-j JOBS]
+                      [--throughput] [--stats]
+                      [--stats-format {json,prometheus}]
+                      [--stats-file PATH] [--stats-top N] [--profile FILE]
+                      [--buffer-size BYTES]
+                      [--db-format {text,binary}] [--convert IN OUT]
+                      [--lookup PATH] [--root-digest] [--sqlite]
+                      [--sqlite-db PATH] [--history PATH]
+                      [--changed-since DAYS] [--find-hash HASH]
+                      [--digest {sha256,blake2b,sha512_256,blake3}]
+                      [--mmap-threshold BYTES] [--keep-cache]
+                      [--nice N] [--ionice CLASS[:LEVEL]] [--max-rate MB]
+                      [--max-load LOAD] [--format {text,json,csv}]
+                      [--golden PATH] [--golden-mask FIELDS]
+                      [--packages] [--package-hash] [--stream]
+                      [--max-per-dir N]
+                      [--root PATH] [--only PATH]
+                      [--checkpoint-interval SECONDS] [--resume]
+                      [--parallel-roots]
+                      [--daemon] [--rescan-interval SECONDS]
 
     File integrity check.
 
@@ -21,24 +42,125 @@
                             Configuration file.
       -s SIZE, --size SIZE  max size of file to hash (default = 50M)
       -u, --update          update database
+      --db PATH             baseline db (default = /var/lib/ficheck/ficheck.db)
+      --new-db PATH         db written by this run before it replaces the
+                            baseline (default = /run/ficheck.db.new)
+      --report-file PATH    report spool file (default = /run/ficheck.txt)
       -V, --version         print version number
       -r, --report          produce a report
+      -i, --incremental     reuse hashes from the old db for unchanged files
+      --rehash-days DAYS    with -i, force a full rehash if the last one is
+                            older than DAYS days (default = 0, never)
+      --sample PCT          with -i, rehash a random PCT percent of unchanged
+                            files anyway (default = 0)
+      -j JOBS, --jobs JOBS  number of files to hash concurrently (default = 1)
+      --throughput          print files/s and MB/s hashed to stderr, with
+                            per-root timings
+      --stats               report per-phase timings, counters and the slowest
+                            files to stderr or --stats-file
+      --stats-format {json,prometheus}
+                            format of --stats (default = json)
+      --stats-file PATH     write --stats to PATH instead of stderr, e.g. for
+                            the node_exporter textfile collector
+      --stats-top N         number of slowest files to hash listed by --stats
+                            (default = 10)
+      --profile FILE        run under cProfile and dump pstats to FILE (main
+                            thread only)
+      --root PATH           rescan only this configured Directory and keep the
+                            rest of the old db (may be repeated)
+      --only PATH           rescan only this path and everything below it and
+                            keep the rest of the old db (may be repeated)
+      --checkpoint-interval SECONDS
+                            save walk progress for --resume this often
+                            (default = 60, 0 = never)
+      --resume              carry on from the last checkpoint of an
+                            interrupted run, if there is one
+      --parallel-roots      scan roots on different devices concurrently
+      --daemon              watch the roots with inotify and report changes
+                            to the baseline as they happen
+      --rescan-interval SECONDS
+                            with --daemon, also do a full scan this often
+                            (default = 0, only on queue overflow)
+      --buffer-size BYTES   write buffer for the new db (default = 1048576)
+      --db-format {text,binary}
+                            format of the db written by this run (default = text)
+      --convert IN OUT      convert db IN to --db-format and write it to OUT
+      --lookup PATH         print the old db entry for a single path
+      --root-digest         print the directory digest of the whole old db
+                            and exit
+      --sqlite              with -u, also record this scan in the SQLite history
+      --sqlite-db PATH      SQLite history store (default =
+                            /var/lib/ficheck/ficheck.sqlite)
+      --history PATH        print the SQLite history of a single path
+      --changed-since DAYS  print paths changed in the last DAYS days
+      --find-hash HASH      print every path ever recorded with hash HASH
+      --digest {sha256,blake2b,sha512_256,blake3}
+                            hash algorithm (default = Digest from the config
+                            file, or sha256); blake3 needs the blake3 module
+      --mmap-threshold BYTES
+                            hash files at least this big through mmap rather than
+                            read() (default = 0, never)
+      --keep-cache          don't drop hashed files from the page cache
+      --nice N              add N to the process nice value
+      --ionice CLASS[:LEVEL]
+                            I/O scheduling class (idle, best-effort or
+                            realtime, optionally with a level 0-7)
+      --max-rate MB         cap hashing reads at MB megabytes per second
+      --max-load LOAD       pause the walk while the 1 minute load average
+                            is above LOAD
+      --format {text,json,csv}
+                            report format (default = text)
+      --golden PATH         compare this scan with the golden db PATH instead
+                            of the old db
+      --golden-mask FIELDS  with --golden, fields not compared
+                            (default = inode,links,ctime,mtime,btime)
+      --packages            check hashed files owned by dpkg/rpm packages
+                            against the package manifests
+      --package-hash        with --packages, store Pkg instead of a hash for
+                            files that match their package
+      --stream              with -r, write the report to stdout as it is
+                            produced instead of via the report file
+      --max-per-dir N       report at most N changes per directory and
+                            summarize the rest (default = 0, no limit)
 
 """
 
+import cProfile
 import csv
+import ctypes
+import ctypes.util
 #import configparser
 import os
 import errno
+import fcntl
+import fnmatch
+import re
+import select
 import signal
 import sys
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import argparse
+import atexit
 import hashlib
+import glob
+import heapq
 import socket
+import subprocess
+import tempfile
+import sqlite3
+import io
 import itertools
+import json
+import mmap
+import random
+import struct
 import shutil
-from datetime import datetime,timezone
+from datetime import datetime,timedelta,timezone
 # pylint: disable=wildcard-import,unused-wildcard-import
 from stat import *
 # pylint: enable=wildcard-import
@@ -51,244 +173,1437 @@ except (ImportError, ModuleNotFoundError):
     have_statx = False
 else:
     have_statx = True
+try:
+    import blake3
+except (ImportError, ModuleNotFoundError):
+    have_blake3 = False
+else:
+    have_blake3 = True
 
-__version_info__ = (1, 0, 3)
+__version_info__ = (1, 21, 0)
 __version__ = ".".join(map(str, __version_info__))
 new_db_file_path = "/run/ficheck.db.new"
 old_db_file_path = "/var/lib/ficheck/ficheck.db"
 report_file_path = "/run/ficheck.txt"
-changes = 0
+sqlite_db_file_path = "/var/lib/ficheck/ficheck.sqlite"
 total_changes = 0
 hostname = socket.gethostname()
+# Every digest is 32 bytes so the binary db can store any of them
+DIGESTS = {
+    'sha256': hashlib.sha256,
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+}
+if 'sha512_256' in hashlib.algorithms_available:
+    DIGESTS['sha512_256'] = lambda: hashlib.new('sha512_256')
+if have_blake3:
+    DIGESTS['blake3'] = blake3.blake3
+DEFAULT_DIGEST = 'sha256'
+READ_SIZE = 65536
+MMAP_CHUNK = 1048576
+BEGIN_MARKER = "#-----------------BEGIN DIRECTORY "
+MARKER_TAIL = "--------------------"
+read_buffers = threading.local()
 args = None
 report = None
+db_writer = None
+baseline = {}
+racy_after = None
+files_hashed = 0
+bytes_hashed = 0
+entries_scanned = 0
+root_stats = {}
+phase_times = {}
+stat_calls = 0
+open_calls = 0
+hash_seconds = 0.0
+slowest_files = []
+package_index = {}
+package_mismatches = []
+lock_file = None
+checkpoint_path = None
+checkpoint_state = None
+next_checkpoint = 0.0
+load_paused = 0.0
+throttle = None
+stats_lock = threading.Lock()
 
 # pylint: disable=too-many-locals,too-many-branches,too-many-statements,too-many-arguments,line-too-long,too-many-nested-blocks
-def write_file(filepath, inode, perms, links, uid, gid, size, ctime, mtime, btime, file_hash):
-    """Write entry to new db file"""
+class DbWriter:
+    """Buffered writer for the new db, renamed into place by close()"""
+
+    def __init__(self, path, buffer_size, resume_offset=None):
+        self.path = path
+        self.part_path = path + ".part"
+        if resume_offset is None:
+            fd = os.open(self.part_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+        else:
+            fd = os.open(self.part_path, os.O_WRONLY)
+            os.ftruncate(fd, resume_offset)
+            os.lseek(fd, 0, os.SEEK_END)
+        self.file = os.fdopen(fd, 'w', newline='', encoding='utf-8', buffering=buffer_size)
+        self.line = io.StringIO(newline='')
+        self.writer = csv.writer(self.line, delimiter='&')
+        self.tree = TreeBuilder() if resume_offset is None else None
+        self.offset = 0
+
+    def _write(self, text):
+        self.file.write(text)
+        self.offset += len(text) if text.isascii() else len(text.encode('utf-8'))
+
+    def comment(self, text):
+        """Write a header comment line"""
+        self._write(text + "\n")
+
+    def begin_directory(self, root_dir):
+        """Start the section for one configured Directory"""
+        if self.tree is not None:
+            self.tree.begin_directory(root_dir)
+        self._write(marker_line(root_dir) + "\n")
+
+    def end_directories(self):
+        """Mark the end of the last section"""
+        self._write("#-----------------END DIRECTORIES--------------------\n")
+
+    def row(self, row):
+        """Write one file entry"""
+        fields = '&'.join(map(str, row))
+        if fields.count('&') == 10 and '"' not in fields and '\n' not in fields and '\r' not in fields:
+            text = fields + '\r\n'
+        else:
+            # let csv quote the fields that need it
+            self.writer.writerow(row)
+            text = self.line.getvalue()
+            self.line.seek(0)
+            self.line.truncate()
+        start = self.offset
+        self._write(text)
+        if self.tree is not None:
+            self.tree.row(row[0], fields, start, self.offset)
+
+    def sync(self):
+        """Flush and fsync what was written so far, returning its size"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return os.fstat(self.file.fileno()).st_size
+
+    def close(self):
+        """Flush, fsync and move the finished db into place"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.part_path, self.path)
+
+# Binary db layout (all integers little endian):
+#   header     BIN_HEADER: magic, version, record count, then the offsets of
+#              the comment, perms, prefix and section tables, the name blob,
+#              the fixed-width records and the path-sorted index
+#   tables     u32 count followed by u32 length + utf-8 bytes per string;
+#              sections are root string + u32 first record + u32 count
+#   records    BIN_RECORD each, path split into an interned directory
+#              prefix and a basename in the name blob, digest as raw bytes
+#   index      u32 record numbers sorted by full path, for binary search
+BIN_MAGIC = b"FICHKDB\x01"
+BIN_HEADER = struct.Struct("<8sII7Q")
+BIN_RECORD = struct.Struct("<IIIQHIIIQqqqB32s")
+BIN_INDEX = struct.Struct("<I")
+# hash field kinds; anything that is not a 32 byte hex digest or one of the
+# placeholder strings is stored as text in the digest slot
+HASH_DIGEST, HASH_TEXT = 0, 1
+
+def _pack_strings(strings):
+    """Encode a string table"""
+
+    out = bytearray(BIN_INDEX.pack(len(strings)))
+    for item in strings:
+        data = item.encode('utf8', 'surrogateescape')
+        out += BIN_INDEX.pack(len(data)) + data
+    return out
+
+def _unpack_string(data, offset):
+    """Decode one length-prefixed string, returning it and the offset after it"""
+
+    (length,) = BIN_INDEX.unpack_from(data, offset)
+    offset += BIN_INDEX.size
+    return bytes(data[offset:offset + length]).decode('utf8', 'surrogateescape'), offset + length
+
+def _unpack_strings(data, offset):
+    """Decode a string table, returning the list and the offset after it"""
+
+    (count,) = BIN_INDEX.unpack_from(data, offset)
+    offset += BIN_INDEX.size
+    strings = []
+    for _ in range(count):
+        item, offset = _unpack_string(data, offset)
+        strings.append(item)
+    return strings, offset
+
+def _format_time(value, zero_as_int=False):
+    """Render a timestamp the way process_entry() writes it"""
+
+    if zero_as_int and value == 0:
+        return "0"
+    # pylint: disable=consider-using-f-string
+    return "{:10.0f}".format(value)
+
+class BinaryDbWriter:
+    """Writer for the compact binary db format, held in memory until the index is written"""
+
+    def __init__(self, path, buffer_size):
+        self.path = path
+        self.part_path = path + ".part"
+        self.buffer_size = buffer_size
+        self.comments = []
+        self.sections = []
+        self.perms = {}
+        self.prefixes = {}
+        self.names = bytearray()
+        self.records = bytearray()
+        self.paths = []
+        self.tree = TreeBuilder()
+
+    def comment(self, text):
+        """Keep a header comment line"""
+        self.comments.append(text)
+
+    def begin_directory(self, root_dir):
+        """Start the section for one configured Directory"""
+        self.sections.append([root_dir, len(self.paths), 0])
+        self.tree.begin_directory(root_dir)
+
+    def end_directories(self):
+        """Sections are closed implicitly"""
+
+    def row(self, row):
+        """Pack one file entry"""
+        filepath, inode, perms, links, uid, gid, size, ctime, mtime, btime, file_hash = row
+        prefix, name = os.path.split(filepath)
+        prefix_no = self.prefixes.setdefault(prefix, len(self.prefixes))
+        perms_no = self.perms.setdefault(perms, len(self.perms))
+        name_data = name.encode('utf8', 'surrogateescape')
+        file_hash = str(file_hash)
+        if len(file_hash) == 64 and all(c in "0123456789abcdef" for c in file_hash):
+            kind, digest = HASH_DIGEST, bytes.fromhex(file_hash)
+        elif len(file_hash) <= 32:
+            kind, digest = HASH_TEXT, file_hash.encode('ascii')
+        else:
+            raise ValueError(f"{filepath}: hash {file_hash} does not fit the binary db format")
+        self.records += BIN_RECORD.pack(
+            prefix_no, len(self.names), len(name_data), int(inode), perms_no,
+            int(links), int(uid), int(gid), int(size),
+            int(ctime), int(mtime), int(btime), kind, digest)
+        self.names += name_data
+        # digest the row as BinaryDb.lines() will read it back
+        fields = [filepath, str(int(inode)), perms, str(int(links)), str(int(uid)), str(int(gid)),
+                  str(int(size)), f"{int(ctime):10d}", f"{int(mtime):10d}",
+                  f"{int(btime):10d}" if int(btime) else "0",
+                  digest.hex() if kind == HASH_DIGEST else file_hash]
+        self.tree.row(filepath, '&'.join(fields), len(self.paths), len(self.paths) + 1)
+        self.paths.append(filepath)
+        if self.sections:
+            self.sections[-1][2] += 1
+
+    def close(self):
+        """Lay out the tables, fsync and move the finished db into place"""
+        blocks = [
+            _pack_strings(self.comments),
+            _pack_strings(list(self.perms)),
+            _pack_strings(list(self.prefixes)),
+        ]
+        sections = bytearray(BIN_INDEX.pack(len(self.sections)))
+        for root_dir, first, count in self.sections:
+            sections += _pack_strings([root_dir])[BIN_INDEX.size:] + struct.pack("<II", first, count)
+        blocks.append(sections)
+        blocks.append(self.names)
+        blocks.append(self.records)
+        order = sorted(range(len(self.paths)), key=self.paths.__getitem__)
+        blocks.append(b"".join(BIN_INDEX.pack(i) for i in order))
+        offsets = []
+        offset = BIN_HEADER.size
+        for block in blocks:
+            offsets.append(offset)
+            offset += len(block)
+        fd = os.open(self.part_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb', buffering=self.buffer_size) as file:
+            file.write(BIN_HEADER.pack(BIN_MAGIC, 1, len(self.paths), *offsets))
+            for block in blocks:
+                file.write(block)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.part_path, self.path)
+
+class BinaryDb:
+    """Read access to a binary db, including lookup of a single path"""
+
+    def __init__(self, data):
+        self.data = data
+        magic, _, self.count, *offsets = BIN_HEADER.unpack_from(data, 0)
+        if magic != BIN_MAGIC:
+            raise ValueError("not a binary ficheck db")
+        comments_off, perms_off, prefixes_off, sections_off, self.names_off, self.records_off, self.index_off = offsets
+        self.comments, _ = _unpack_strings(data, comments_off)
+        self.perms, _ = _unpack_strings(data, perms_off)
+        self.prefixes, _ = _unpack_strings(data, prefixes_off)
+        self.sections = []
+        (count,) = BIN_INDEX.unpack_from(data, sections_off)
+        offset = sections_off + BIN_INDEX.size
+        for _ in range(count):
+            root, offset = _unpack_string(data, offset)
+            first, total = struct.unpack_from("<II", data, offset)
+            offset += 8
+            self.sections.append((root, first, total))
+
+    def record(self, number):
+        """Decode record number into a db row"""
+        (prefix_no, name_off, name_len, inode, perms_no, links, uid, gid, size,
+         ctime, mtime, btime, kind, digest) = BIN_RECORD.unpack_from(
+             self.data, self.records_off + number * BIN_RECORD.size)
+        start = self.names_off + name_off
+        name = bytes(self.data[start:start + name_len]).decode('utf8', 'surrogateescape')
+        if kind == HASH_DIGEST:
+            file_hash = digest.hex()
+        else:
+            file_hash = digest.rstrip(b"\0").decode('ascii')
+        return [os.path.join(self.prefixes[prefix_no], name), str(inode), self.perms[perms_no],
+                str(links), str(uid), str(gid), str(size), _format_time(ctime),
+                _format_time(mtime), _format_time(btime, True), file_hash]
+
+    def lines(self):
+        """Yield header, markers and rows the same way csv.reader does for a text db"""
+        for comment in self.comments:
+            yield [comment]
+        names = bytes(self.data[self.names_off:self.records_off])
+        records = BIN_RECORD.iter_unpack(self.data[self.records_off:self.index_off])
+        prefixes = [prefix if prefix.endswith('/') else prefix + '/' for prefix in self.prefixes]
+        perms = self.perms
+        for root_dir, _, total in self.sections:
+            yield [marker_line(root_dir)]
+            for (prefix_no, name_off, name_len, inode, perms_no, links, uid, gid, size,
+                 ctime, mtime, btime, kind, digest) in itertools.islice(records, total):
+                yield [prefixes[prefix_no] + names[name_off:name_off + name_len].decode('utf8', 'surrogateescape'),
+                       str(inode), perms[perms_no], str(links), str(uid), str(gid), str(size),
+                       f"{ctime:10d}", f"{mtime:10d}", f"{btime:10d}" if btime else "0",
+                       digest.hex() if kind == HASH_DIGEST else digest.rstrip(b"\0").decode('ascii')]
+        yield ["#-----------------END DIRECTORIES--------------------"]
+
+    def sorted_rows(self):
+        """Yield every row in path order, using the path index"""
+        for (number,) in BIN_INDEX.iter_unpack(self.data[self.index_off:self.index_off + self.count * BIN_INDEX.size]):
+            yield self.record(number)
+
+    def lookup(self, path):
+        """Binary search the path index for a single row"""
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            (number,) = BIN_INDEX.unpack_from(self.data, self.index_off + mid * BIN_INDEX.size)
+            row = self.record(number)
+            if row[0] == path:
+                return row
+            if row[0] < path:
+                low = mid + 1
+            else:
+                high = mid
+        return None
+
+def is_binary_db(db_path):
+    """Check a db file for the binary format magic"""
+
+    with open(db_path, 'rb') as file:
+        return file.read(len(BIN_MAGIC)) == BIN_MAGIC
+
+def read_db(db_path):
+    """Yield the lines of a text or binary db as lists of fields"""
+
+    if is_binary_db(db_path):
+        with open(db_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from BinaryDb(data).lines()
+    else:
+        with open(db_path, 'r', encoding='utf8') as file:
+            yield from csv.reader(file, delimiter='&')
+
+def lookup_db(db_path, path):
+    """Find the row for a single path in either db format"""
+
+    if is_binary_db(db_path):
+        with open(db_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return BinaryDb(data).lookup(path)
+    for line in read_db(db_path):
+        if len(line) == 11 and line[0] == path:
+            return line
+    return None
+
+def open_db_writer(path):
+    """Create the writer for the configured --db-format"""
+
+    if args.db_format == 'binary':
+        return BinaryDbWriter(path, args.buffer_size)
+    return DbWriter(path, args.buffer_size)
+
+def convert_db(src_path, dst_path):
+    """Rewrite a db in the --db-format format"""
+
+    writer = open_db_writer(dst_path)
+    for line in read_db(src_path):
+        if len(line) == 11:
+            writer.row(line)
+        elif marker_root(line) is not None:
+            writer.begin_directory(marker_root(line))
+        elif 'END DIRECTORIES' in line[0]:
+            writer.end_directories()
+        else:
+            writer.comment(line[0])
+    writer.close()
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    host TEXT NOT NULL,
+    started TEXT NOT NULL,
+    started_epoch INTEGER NOT NULL,
+    config TEXT,
+    added INTEGER NOT NULL DEFAULT 0,
+    modified INTEGER NOT NULL DEFAULT 0,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT NOT NULL,
+    scan_id INTEGER NOT NULL REFERENCES scans(id),
+    state TEXT NOT NULL,
+    inode INTEGER, perms TEXT, links INTEGER, uid INTEGER, gid INTEGER,
+    size INTEGER, ctime INTEGER, mtime INTEGER, btime INTEGER, hash TEXT,
+    PRIMARY KEY (path, scan_id)
+);
+CREATE TABLE IF NOT EXISTS current (
+    path TEXT PRIMARY KEY,
+    scan_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_scan ON files(scan_id);
+CREATE INDEX IF NOT EXISTS files_inode ON files(inode);
+CREATE INDEX IF NOT EXISTS files_hash ON files(hash);
+CREATE INDEX IF NOT EXISTS files_mtime ON files(mtime);
+"""
+
+def open_sqlite(db_path):
+    """Open (and create if needed) the SQLite history store"""
 
-    # Append the new user data
-    # pylint: disable=redefined-outer-name
-    with open(new_db_file_path, 'a', newline='', encoding='utf8') as file:
-        writer = csv.writer(file, delimiter='&')
-        writer.writerow([filepath, inode, perms, links, uid, gid, size, ctime, mtime, btime, file_hash])
+    Path(os.path.dirname(db_path)).mkdir(parents=True, exist_ok=True)
+    # create it 0600 like the dbs, SQLite's journals copy its mode
+    os.close(os.open(db_path, os.O_CREAT | os.O_WRONLY, 0o600))
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SQLITE_SCHEMA)
+    return conn
+
+def sqlite_values(line):
+    """Convert a db row to the column values stored in SQLite"""
+
+    return (int(line[1]), line[2], int(line[3]), int(line[4]), int(line[5]),
+            int(line[6]), int(line[7]), int(line[8]), int(line[9]), line[10])
+
+def record_scan(db_path, new_db_path, started):
+    """Store the rows of the new db that differ from the latest SQLite state"""
+
+    conn = open_sqlite(db_path)
+    with conn:
+        latest = {}
+        for row in conn.execute(
+                "SELECT f.path, f.inode, f.perms, f.links, f.uid, f.gid, f.size, f.ctime, f.mtime, f.btime, f.hash "
+                "FROM files f JOIN current c ON f.path = c.path AND f.scan_id = c.scan_id "
+                "WHERE f.state != 'deleted'"):
+            latest[row[0]] = row[1:]
+        first = conn.execute("SELECT COUNT(*) FROM scans").fetchone()[0] == 0
+        epoch = int(datetime.fromisoformat(started).timestamp())
+        scan_id = conn.execute(
+            "INSERT INTO scans (host, started, started_epoch, config) VALUES (?, ?, ?, ?)",
+            (hostname, started, epoch, args.config)).lastrowid
+        counts = {'added': 0, 'modified': 0, 'deleted': 0}
+        inserts = []
+        seen = set()
+        for line in read_db(new_db_path):
+            if len(line) != 11 or line[0] in seen:
+                continue
+            seen.add(line[0])
+            values = sqlite_values(line)
+            old = latest.pop(line[0], None)
+            if old == values:
+                continue
+            if first:
+                state = 'baseline'
+            else:
+                state = 'added' if old is None else 'modified'
+                counts[state] += 1
+            inserts.append((line[0], scan_id, state) + values)
+        for path in latest:
+            counts['deleted'] += 1
+            inserts.append((path, scan_id, 'deleted') + (None,) * 10)
+        conn.executemany("INSERT INTO files VALUES (" + ", ".join("?" * 13) + ")", inserts)
+        conn.executemany("INSERT OR REPLACE INTO current VALUES (?, ?)",
+                         ((item[0], scan_id) for item in inserts))
+        conn.execute("UPDATE scans SET added = ?, modified = ?, deleted = ? WHERE id = ?",
+                     (counts['added'], counts['modified'], counts['deleted'], scan_id))
+    conn.close()
+
+def query_sqlite(db_path):
+    """Answer --history, --changed-since and --find-hash from the SQLite store"""
+
+    if not os.path.exists(db_path):
+        print (f"{os.strerror(errno.ENOENT)}: {db_path}", file=sys.stderr)
+        sys.exit(255)
+    conn = sqlite3.connect(db_path)
+    query = ("SELECT s.started, f.state, f.path, f.inode, f.perms, f.size, f.mtime, f.hash "
+             "FROM files f JOIN scans s ON s.id = f.scan_id ")
+    if args.history:
+        rows = conn.execute(query + "WHERE f.path = ? ORDER BY f.scan_id",
+                            (os.path.abspath(args.history),))
+    elif args.changed_since is not None:
+        cutoff = int(time.time() - args.changed_since * 86400)
+        rows = conn.execute(query + "WHERE s.started_epoch >= ? AND f.state != 'baseline' "
+                            "ORDER BY f.scan_id, f.path", (cutoff,))
+    else:
+        rows = conn.execute(query + "WHERE f.hash = ? ORDER BY f.path, f.scan_id", (args.find_hash,))
+    writer = csv.writer(sys.stdout, delimiter='&', lineterminator='\n')
+    for row in rows:
+        writer.writerow(["" if value is None else value for value in row])
+    conn.close()
+
+# Change records produced by diff_dbs(). kind is one of 'notice', 'section',
+# 'added', 'deleted' or 'modified'; old/new are the db rows involved and
+# fields is a list of (index, old value, new value) for 'modified'.
+# cap_changes() adds 'summary' records, with path the directory and fields
+# a {kind: count} dict of the changes left out, and compare_files() adds
+# 'package' records for files that don't match their package manifest,
+# with fields (digest name, expected, actual).
+Change = namedtuple("Change", "kind root path old new fields")
+FIELD_NAMES = {1: 'Inodes', 2: 'Perms', 3: 'Links', 4: 'Uid', 5: 'Gid', 6: 'Size',
+               7: 'Ctime', 8: 'Mtime', 9: 'Btime', 10: 'Hashes'}
+PLACEHOLDER_HASHES = ('0', 'Dir', 'Device', 'Pkg')
+# names for --golden-mask and ficheck-fleet.py, and the row fields compared
+MASK_FIELDS = {'inode': 1, 'perms': 2, 'links': 3, 'uid': 4, 'gid': 5, 'size': 6,
+               'ctime': 7, 'mtime': 8, 'btime': 9, 'hash': 10}
+compared_fields = tuple(range(1, 11))
+
+def parse_field_mask(text):
+    """Turn a comma separated list of MASK_FIELDS names into row indexes"""
+
+    mask = set()
+    for name in filter(None, (name.strip().lower() for name in text.split(','))):
+        if name not in MASK_FIELDS:
+            raise ValueError(f"unknown field {name}, choose from {', '.join(MASK_FIELDS)}")
+        mask.add(MASK_FIELDS[name])
+    return mask
+
+def db_header(db_path):
+    """Return the '# - - ' header fields of a db"""
+
+    header = {}
+    for line in read_db(db_path):
+        if len(line) != 1 or line[0][0:2] != '# ':
+            break
+        if line[0][0:6] == '# - - ':
+            key, value = header_field(line)
+            header[key] = value
+    return header
+
+def db_sections(db_path):
+    """Return the roots of the BEGIN DIRECTORY sections in a db, in order"""
+
+    if is_binary_db(db_path):
+        with open(db_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return [section[0] for section in BinaryDb(data).sections]
+    roots = []
+    with open(db_path, 'r', encoding='utf8') as file:
+        for text in file:
+            if text.startswith(BEGIN_MARKER):
+                roots.append(marker_root([text.rstrip('\n')]))
+    return roots
+
+def marker_line(root_dir):
+    """Return the BEGIN DIRECTORY marker line for root_dir"""
+
+    return f"{BEGIN_MARKER}{root_dir}{MARKER_TAIL}"
+
+def marker_root(line):
+    """Return the root of a BEGIN DIRECTORY marker line, or None"""
+
+    if len(line) == 1 and line[0].startswith(BEGIN_MARKER) and line[0].endswith(MARKER_TAIL):
+        return line[0][len(BEGIN_MARKER):-len(MARKER_TAIL)]
+    return None
+
+class SectionReader:
+    """Hands out the sections of a db one at a time"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lines = None
+        self.held = None
+
+    def _next_line(self):
+        if self.held is not None:
+            line, self.held = self.held, None
+            return line
+        return next(self.lines, None)
+
+    def rows(self, root_dir):
+        """Yield the rows of the section for root_dir"""
+        for _ in range(2):
+            if self.lines is None:
+                self.lines = read_db(self.db_path)
+            line = self._next_line()
+            while line is not None and marker_root(line) != root_dir:
+                line = self._next_line()
+            if line is None:
+                self.lines = None
+                continue
+            line = self._next_line()
+            while line is not None and len(line) == 11:
+                yield line
+                line = self._next_line()
+            self.held = line
+            return
+
+def walk_key(root_dir, row):
+    """Sort key that reproduces the walker's order within a section"""
+
+    parent, _, name = row[0].rpartition('/')
+    is_dir = row[2][0:1] == 'd' or row[10] == 'Dir'
+    # only the top level of / is walked, and its files come first
+    if root_dir == '/':
+        return ((), is_dir, name)
+    # a directory's children are one block, subdirectories before files
+    return (tuple(parent[len(root_dir):].split('/')[1:]), not is_dir, name)
+
+def diff_rows(old, new, same_digest):
+    """Return the (index, old, new) differences between two rows"""
+
+    differences = []
+    for idx in compared_fields:
+        if old[idx] != new[idx]:
+            if idx == 10 and not same_digest and old[idx] not in PLACEHOLDER_HASHES \
+                    and new[idx] not in PLACEHOLDER_HASHES:
+                continue
+            differences.append((idx, old[idx], new[idx]))
+    # a directory whose only change is its ctime and mtime just had entries added or removed
+    if old[10] == 'Dir' and {idx for idx, _, _ in differences} == {7, 8}:
+        differences = []
+    return differences
+
+def diff_section(root_dir, old_rows, new_rows, same_digest):
+    """Merge the rows of one section from both dbs in walk order, yielding changes"""
+
+    old = next(old_rows, None)
+    new = next(new_rows, None)
+    while old is not None and new is not None:
+        old_key = walk_key(root_dir, old)
+        new_key = walk_key(root_dir, new)
+        if old_key == new_key:
+            fields = diff_rows(old, new, same_digest)
+            if fields:
+                yield Change('modified', root_dir, new[0], old, new, fields)
+            old = next(old_rows, None)
+            new = next(new_rows, None)
+        elif old_key < new_key:
+            yield Change('deleted', root_dir, old[0], old, None, None)
+            old = next(old_rows, None)
+        else:
+            yield Change('added', root_dir, new[0], None, new, None)
+            new = next(new_rows, None)
+    while old is not None:
+        yield Change('deleted', root_dir, old[0], old, None, None)
+        old = next(old_rows, None)
+    while new is not None:
+        yield Change('added', root_dir, new[0], None, new, None)
+        new = next(new_rows, None)
+
+# Directory digests are kept in a sidecar file next to the db:
+#   # ficheck tree 1 <db size> <db creation time>
+#   R <digest of all sections>
+#   S <section digest> <root>
+#   B <subtree digest> <rows digest> <start> <end> <parent directory>
+# A block is the contiguous run of rows the walker wrote for one directory;
+# start/end are byte offsets in a text db or record numbers in a binary one.
+TREE_SUFFIX = ".tree"
+TreeBlock = namedtuple("TreeBlock", "parent subtree rows start end")
+
+def tree_lines(db_path):
+    """Yield (line, start, end) for each line of a db, positioned for read_block()"""
+
+    if is_binary_db(db_path):
+        with open(db_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            db = BinaryDb(data)
+            for comment in db.comments:
+                yield [comment], 0, 0
+            for root_dir, first, total in db.sections:
+                yield [marker_line(root_dir)], first, first
+                for number in range(first, first + total):
+                    yield db.record(number), number, number + 1
+        return
+    with open(db_path, 'rb') as file:
+        position = [0]
+
+        def lines():
+            for raw in file:
+                position[0] += len(raw)
+                yield raw.decode('utf8')
+
+        start = 0
+        for line in csv.reader(lines(), delimiter='&'):
+            yield line, start, position[0]
+            start = position[0]
+
+def block_key(root_dir, parent):
+    """Walker order of directory blocks within a section"""
+
+    return tuple(parent[len(root_dir):].split('/')[1:]) if root_dir != '/' else ()
+
+class TreeBuilder:
+    """Directory digests of a db, accumulated as its rows go by"""
+
+    def __init__(self):
+        self.sections = {}
+        self.blocks = None
+        self.current = []
+
+    def begin_directory(self, root_dir):
+        """Start the blocks of one section"""
+        self.blocks = self.sections.setdefault(root_dir, [])
+        self.current = []
+
+    def row(self, path, fields, start, end):
+        """Add the row for path, its fields joined with '&', found at start..end in the db"""
+        parent = path.rpartition('/')[0] or '/'
+        if not self.current or self.current[0] != parent:
+            self.current = [parent, hashlib.sha256(), start, end]
+            self.blocks.append(self.current)
+        self.current[1].update((fields + '\n').encode('utf8', 'surrogateescape'))
+        self.current[3] = end
+
+    def digests(self):
+        """Return (root digest, {root: (section digest, [TreeBlock])})"""
+        root_hash = hashlib.sha256()
+        tree = {}
+        for root_dir, raw_blocks in self.sections.items():
+            children = {}
+            subtree = {}
+            for parent, rows_hash, _, _ in reversed(raw_blocks):
+                digest = hashlib.sha256(rows_hash.digest())
+                for child in reversed(children.get(parent, [])):
+                    digest.update(subtree[child])
+                subtree[parent] = digest.digest()
+                children.setdefault(os.path.dirname(parent), []).append(parent)
+            section_digest = subtree.get(root_dir, hashlib.sha256().digest()).hex()
+            tree[root_dir] = (section_digest,
+                              [TreeBlock(parent, subtree[parent].hex(), rows_hash.hexdigest(), start, end)
+                               for parent, rows_hash, start, end in raw_blocks])
+            root_hash.update(f"{root_dir}\0{section_digest}\n".encode('utf8', 'surrogateescape'))
+        return root_hash.hexdigest(), tree
+
+def build_tree(db_path):
+    """Compute the directory digests of an existing db"""
+
+    builder = TreeBuilder()
+    for line, start, end in tree_lines(db_path):
+        if len(line) == 11:
+            builder.row(line[0], '&'.join(line), start, end)
+        elif marker_root(line) is not None:
+            builder.begin_directory(marker_root(line))
+    return builder.digests()
+
+def write_tree(db_path, builder=None):
+    """Write the sidecar directory digest file for a db, from builder if given"""
+
+    root_digest, tree = builder.digests() if builder is not None else build_tree(db_path)
+    creation = db_header(db_path).get('Creation', '-')
+    fd = os.open(db_path + TREE_SUFFIX, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf8', errors='surrogateescape') as file:
+        print (f"# ficheck tree 1 {os.path.getsize(db_path)} {creation}", file=file)
+        print (f"R {root_digest}", file=file)
+        for root_dir, (section_digest, blocks) in tree.items():
+            print (f"S {section_digest} {root_dir}", file=file)
+            for block in blocks:
+                print (f"B {block.subtree} {block.rows} {block.start} {block.end} {block.parent}", file=file)
+
+def load_tree(db_path):
+    """Read a db's sidecar digests, or None if missing or out of date"""
+
+    tree_path = db_path + TREE_SUFFIX
+    if not os.path.exists(tree_path) or not os.path.exists(db_path):
+        return None
+    with open(tree_path, 'r', encoding='utf8', errors='surrogateescape') as file:
+        header = file.readline().split()
+        creation = db_header(db_path).get('Creation', '-')
+        if header[:4] != ['#', 'ficheck', 'tree', '1'] or header[4:] != [str(os.path.getsize(db_path)), creation]:
+            return None
+        root_digest = file.readline().split()[1]
+        tree = {}
+        blocks = None
+        for text in file:
+            text = text.rstrip('\n')
+            if text[0:2] == 'S ':
+                _, digest, root_dir = text.split(' ', 2)
+                blocks = []
+                tree[root_dir] = (digest, blocks)
+            elif text[0:2] == 'B ':
+                _, subtree, rows, start, end, parent = text.split(' ', 5)
+                blocks.append(TreeBlock(parent, subtree, rows, int(start), int(end)))
+    return root_digest, tree
+
+def read_block(db_path, block):
+    """Return the rows of one directory block"""
+
+    if is_binary_db(db_path):
+        with open(db_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            db = BinaryDb(data)
+            return [db.record(number) for number in range(block.start, block.end)]
+    with open(db_path, 'rb') as file:
+        file.seek(block.start)
+        text = file.read(block.end - block.start).decode('utf8')
+    return list(csv.reader(io.StringIO(text, newline=''), delimiter='&'))
+
+def diff_section_tree(root_dir, old_path, old_blocks, new_path, new_blocks, same_digest):
+    """Diff one section, skipping subtrees whose directory digests match"""
+
+    old_by_parent = {block.parent: block for block in old_blocks}
+    new_by_parent = {block.parent: block for block in new_blocks}
+    children = {}
+    for parent in itertools.chain(old_by_parent, new_by_parent):
+        if parent != root_dir:
+            children.setdefault(os.path.dirname(parent), set()).add(parent)
+    dirty = []
+    stack = [root_dir]
+    while stack:
+        parent = stack.pop()
+        old = old_by_parent.get(parent)
+        new = new_by_parent.get(parent)
+        if old is not None and new is not None and old.subtree == new.subtree:
+            continue
+        if old is None or new is None or old.rows != new.rows:
+            dirty.append(parent)
+        stack.extend(children.get(parent, ()))
+    for parent in sorted(dirty, key=lambda parent: block_key(root_dir, parent)):
+        old_rows = read_block(old_path, old_by_parent[parent]) if parent in old_by_parent else []
+        new_rows = read_block(new_path, new_by_parent[parent]) if parent in new_by_parent else []
+        yield from diff_section(root_dir, iter(old_rows), iter(new_rows), same_digest)
+
+def diff_dbs(old_path, new_path):
+    """Compare two dbs section by section, yielding Change records"""
+
+    old_digest = db_header(old_path).get('Digest', DEFAULT_DIGEST)
+    new_digest = db_header(new_path).get('Digest', DEFAULT_DIGEST)
+    same_digest = old_digest == new_digest
+    if not same_digest:
+        yield Change('notice', None, None, None, None,
+                     f"digest changed from {old_digest} to {new_digest}, hashes not compared")
+    old_reader = SectionReader(old_path)
+    new_reader = SectionReader(new_path)
+    # without an up to date sidecar on both sides every section is read in full
+    old_tree = load_tree(old_path)
+    new_tree = load_tree(new_path)
+    if old_tree is None or new_tree is None:
+        old_sections, new_sections = {}, {}
+        old_roots = db_sections(old_path)
+        new_roots = db_sections(new_path)
+    else:
+        old_sections, new_sections = old_tree[1], new_tree[1]
+        old_roots = list(old_sections)
+        new_roots = list(new_sections)
+    for root_dir in new_roots + [root for root in old_roots if root not in new_roots]:
+        yield Change('section', root_dir, None, None, None, None)
+        if root_dir in old_sections and root_dir in new_sections:
+            old_digest, old_blocks = old_sections[root_dir]
+            new_digest, new_blocks = new_sections[root_dir]
+            if old_digest != new_digest:
+                yield from diff_section_tree(root_dir, old_path, old_blocks,
+                                             new_path, new_blocks, same_digest)
+            continue
+        old_rows = old_reader.rows(root_dir) if root_dir in old_roots else iter(())
+        new_rows = new_reader.rows(root_dir) if root_dir in new_roots else iter(())
+        yield from diff_section(root_dir, old_rows, new_rows, same_digest)
+
+def format_time(value):
+    """Render a db timestamp for the report"""
+
+    return strftime('%Y-%m-%d %H:%M:%S', localtime(int(value)))
+
+class TextRenderer:
+    """The classic ficheck report"""
+
+    def __init__(self, out):
+        self.out = out
+        self.section_changes = None
+        self.package_section = False
+
+    def begin(self):
+        """Print the report header"""
+        print (f'Configuration on {hostname} is {args.config}', file = self.out)
+        print ('============================================================', file = self.out)
+        print (file = self.out)
+
+    def change(self, item):
+        """Print one change record"""
+        out = self.out
+        if item.kind == 'notice':
+            print (f"NOTICE: [{hostname}] {item.fields}", file = out)
+            print (file = out)
+        elif item.kind == 'section':
+            self.end_section()
+            print (file = out)
+            print (f"PROGRESS: Current directory: {item.root}", file = out)
+            print ("STATUS: ", end='', file = out)
+            self.section_changes = 0
+        elif item.kind == 'modified':
+            self.count_change()
+            print (file = out)
+            print (f"        WARNING: [{hostname}] {item.path}", file = out)
+            texts = []
+            for idx, val1, val2 in item.fields:
+                if idx in (7, 8, 9):
+                    val1, val2 = format_time(val1), format_time(val2)
+                elif idx == 10 and item.new[2][0:1] == 'l':
+                    val1, val2 = f"SYMLINK:{val1}", f"SYMLINK:{val2}"
+                texts.append(f"{FIELD_NAMES[idx]}: {val1} - {val2}")
+            print ("        [" + ", ".join(texts) + "]", file = out)
+        elif item.kind == 'package':
+            if not self.package_section:
+                self.end_section()
+                print (file = out)
+                print ("PROGRESS: Package verification", file = out)
+                self.section_changes = None
+                self.package_section = True
+            algorithm, expected, actual = item.fields
+            print (file = out)
+            print (f"        PACKAGE: [{hostname}] {item.path} differs from package", file = out)
+            print (f"        [{algorithm}: {expected} - {actual}]", file = out)
+        elif item.kind == 'summary':
+            counts = ", ".join(f"{count} {kind}" for kind, count in item.fields.items())
+            print (file = out)
+            print (f"        SUMMARY: [{hostname}] {sum(item.fields.values())} more changes in {item.path} ({counts})",
+                   file = out)
+        else:
+            self.count_change()
+            row = item.old if item.kind == 'deleted' else item.new
+            label = 'DELETION' if item.kind == 'deleted' else 'ADDITION'
+            print (file = out)
+            print (f"        {label}: [{hostname}] {item.path}", file = out)
+            # pylint: disable=consider-using-f-string
+            print ("        {:<10} {:<12} {:<8} {:<8} {:<8} {:<15} {:<20}".format('Inode','Permissions','NLink','UID','GID','Size','Created On'),
+                    file = out)
+            print ("        {:<10} {:<12} {:<8} {:<8} {:<8} {:<15} {:<20}".format(row[1],row[2],row[3],row[4],row[5],row[6],format_time(row[9])),
+                    file = out)
+
+    def count_change(self):
+        """Note a change in the current section, if there is one"""
+        if self.section_changes is not None:
+            self.section_changes += 1
+
+    def end_section(self):
+        """Close off a section that had nothing to report"""
+        if self.section_changes == 0:
+            print (" passed...", file = self.out)
+
+    def end(self):
+        """Finish the report"""
+        self.end_section()
+        print (file = self.out)
+
+class JsonRenderer:
+    """One JSON object per change, for log pipelines"""
+
+    def __init__(self, out):
+        self.out = out
+
+    def begin(self):
+        """Nothing to print before the first record"""
+
+    def change(self, item):
+        """Print one change record"""
+        if item.kind == 'section':
+            return
+        record = {'host': hostname, 'kind': item.kind}
+        if item.kind == 'notice':
+            record['message'] = item.fields
+        elif item.kind == 'summary':
+            record['root'] = item.root
+            record['path'] = item.path
+            record['counts'] = item.fields
+        elif item.kind == 'package':
+            record['path'] = item.path
+            record['digest'], record['expected'], record['actual'] = item.fields
+        else:
+            record['root'] = item.root
+            record['path'] = item.path
+            if item.kind == 'modified':
+                record['fields'] = {FIELD_NAMES[idx]: [val1, val2] for idx, val1, val2 in item.fields}
+            else:
+                row = item.old if item.kind == 'deleted' else item.new
+                record['entry'] = dict(zip(('inode', 'perms', 'links', 'uid', 'gid', 'size',
+                                            'ctime', 'mtime', 'btime', 'hash'),
+                                           (value.strip() for value in row[1:])))
+        print (json.dumps(record), file = self.out)
+
+    def end(self):
+        """Nothing to print after the last record"""
+
+class CsvRenderer:
+    """kind&root&path&field&old&new rows, one per changed field"""
+
+    def __init__(self, out):
+        self.out = out
+        self.writer = csv.writer(out, delimiter='&', lineterminator='\n')
+
+    def begin(self):
+        """Print the column names"""
+        self.writer.writerow(['kind', 'root', 'path', 'field', 'old', 'new'])
+
+    def change(self, item):
+        """Print one change record"""
+        if item.kind == 'notice':
+            self.writer.writerow(['notice', '', '', '', '', item.fields])
+        elif item.kind == 'modified':
+            for idx, val1, val2 in item.fields:
+                self.writer.writerow([item.kind, item.root, item.path, FIELD_NAMES[idx], val1.strip(), val2.strip()])
+        elif item.kind in ('added', 'deleted'):
+            self.writer.writerow([item.kind, item.root, item.path, '', '', ''])
+        elif item.kind == 'summary':
+            for kind, count in item.fields.items():
+                self.writer.writerow([item.kind, item.root, item.path, kind, '', count])
+        elif item.kind == 'package':
+            algorithm, expected, actual = item.fields
+            self.writer.writerow([item.kind, '', item.path, algorithm, expected, actual])
+
+    def end(self):
+        """Nothing to print after the last record"""
+
+RENDERERS = {'text': TextRenderer, 'json': JsonRenderer, 'csv': CsvRenderer}
+
+class DeferredOutput:
+    """Hold writes back until release(), then pass them straight through"""
+
+    def __init__(self, out):
+        self.out = out
+        self.held = []
+        self.released = False
+
+    def write(self, text):
+        """Write or hold text"""
+        if self.released:
+            return self.out.write(text)
+        self.held.append(text)
+        return len(text)
+
+    def release(self):
+        """Write out what was held and stop holding"""
+        if not self.released:
+            self.released = True
+            self.out.write("".join(self.held))
+            self.held = []
+
+    def flush(self):
+        """Flush the underlying stream once released"""
+        if self.released:
+            self.out.flush()
+
+def cap_changes(items, limit):
+    """Pass through at most limit changes per directory, summarizing the rest"""
+
+    parent = None
+    count = 0
+    skipped = {}
+    for item in items:
+        if item.kind in ('added', 'deleted', 'modified'):
+            item_parent = item.path.rpartition('/')[0] or '/'
+            if item_parent != parent:
+                if skipped:
+                    yield Change('summary', root_dir, parent, None, None, skipped)
+                parent, root_dir, count, skipped = item_parent, item.root, 0, {}
+            count += 1
+            if count > limit:
+                skipped[item.kind] = skipped.get(item.kind, 0) + 1
+                continue
+        else:
+            if skipped:
+                yield Change('summary', root_dir, parent, None, None, skipped)
+            parent, skipped = None, {}
+        yield item
+    if skipped:
+        yield Change('summary', root_dir, parent, None, None, skipped)
 
 def compare_files(file1_path, file2_path):
     """Compare new and old dbs"""
-    global changes
     global total_changes
 
     if not args.report:
         return
-    def get_next_line(reader):
-        """Skip malformed lines and return valid entries"""
+    out = DeferredOutput(sys.stdout) if args.stream else report
+    renderer = RENDERERS[args.format](out)
+    renderer.begin()
+    items = diff_dbs(file1_path, file2_path)
+    if args.max_per_dir:
+        items = cap_changes(items, args.max_per_dir)
+    items = itertools.chain(items, (Change('package', None, fname, None, None, (algorithm, expected, actual))
+                                    for fname, algorithm, expected, actual in sorted(package_mismatches)))
+    for item in items:
+        if item.kind == 'summary':
+            total_changes += sum(item.fields.values())
+        elif item.kind != 'section':
+            total_changes += 1
+            if args.stream:
+                out.release()
+        renderer.change(item)
+    renderer.end()
+    out.flush()
+
+def load_baseline(db_path):
+    """Read old db into a dict keyed by path, plus its header fields"""
+
+    entries = {}
+    header = {}
+    if not os.path.exists(db_path):
+        return entries, header
+    for line in read_db(db_path):
+        if len(line) == 11:
+            entries[line[0]] = line
+        elif len(line) == 1 and line[0][0:6] == '# - - ':
+            key, value = header_field(line)
+            header[key] = value
+    return entries, header
+
+def header_field(line):
+    """Split a '# - - Key value' header line"""
+
+    key, _, value = line[0][6:].partition(' ')
+    return key, value.strip()
+
+def scan_second(header):
+    """Return the whole second a db's scan started in, or None"""
+
+    try:
+        return int(datetime.fromisoformat(header['Creation']).timestamp())
+    except (KeyError, ValueError):
+        return None
+
+def need_full_rehash(header):
+    """Decide whether an incremental run must rehash everything anyway"""
+
+    if not args.incremental:
+        return True
+    if 'Fullhash' not in header:
+        return True
+    if header.get('Digest', DEFAULT_DIGEST) != args.digest:
+        return True
+    if args.rehash_days > 0:
         try:
-            while True:
-                line = next(reader)
-                return line
-        except StopIteration:
-            return None
+            last = datetime.fromisoformat(header['Fullhash'])
+        except ValueError:
+            return True
+        if datetime.now(timezone.utc) - last > timedelta(days=args.rehash_days):
+            return True
+    return False
 
-    with open(file1_path, 'r', encoding='utf8') as f1, open(file2_path, 'r', encoding='utf8') as f2:
-        reader1 = csv.reader(f1, delimiter='&')
-        reader2 = csv.reader(f2, delimiter='&')
+def reuse_hash(fname, status, ctime, mtime):
+    """Return the old db hash for fname if its stat metadata is unchanged"""
 
-        line1 = get_next_line(reader1)
-        line2 = get_next_line(reader2)
+    old = baseline.get(fname)
+    if old is None:
+        return None
+    # db times are whole seconds, so a file changed in the second the old
+    # scan started (or later) may have been rewritten after it was hashed
+    if racy_after is None or int(old[7]) >= racy_after:
+        return None
+    if (old[1] != str(status.st_ino) or old[6] != str(status.st_size)
+            or old[7] != ctime or old[8] != mtime):
+        return None
+    # a "0" hash may just mean the file was over --size last time
+    if old[10] == "0" and status.st_size <= args.size:
+        return None
+    if old[10] == "Pkg" and not args.package_hash:
+        return None
+    if args.sample > 0 and random.random() * 100 < args.sample:
+        return None
+    return old[10]
 
-        print (f'Configuration on {hostname} is {args.config}', file = report)
-        print ('============================================================', file = report)
-        print (file = report)
-        while line1:
-            if line1[0][0:2] == '# ':
-                line1 = get_next_line(reader1)
-            else:
-                break
-        while line2:
-            if line2[0][0:2] == '# ':
-                line2 = get_next_line(reader2)
-            else:
-                break
-
-        while line1 and line2:
-            key1, key2 = line1[0], line2[0]
-            if key1 == key2 and len(line1) == len(line2):
-                if len(line1) == 1:
-                    if 'BEGIN' in key1:
-                        total_changes += changes
-                        if changes == 0 and key1.split(' ')[2].split('-')[0] != '/':
-                            print (" passed...", file = report)
-
-                        changes = 0
-                        # Print current directory
-                        my_root = key1.split(' ')[2].split('-')[0]
-                        print (file = report)
-                        print (f"PROGRESS: Current directory: {my_root}", file = report)
-                        print ("STATUS: ",end='', file = report)
-                        line1 = get_next_line(reader1)
-                        line2 = get_next_line(reader2)
-                    elif 'END' in key1:
-                        line1 = get_next_line(reader1)
-                        line2 = get_next_line(reader2)
-                    continue
-
-                # Check fields 2-11 (indexes 1-10)
-                differences = []
-                for idx in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]:
-                    if line1[idx] != line2[idx]:
-                        differences.append( (idx, line1[idx], line2[idx]) )
-
-                if line1[10] == 'Dir' and len(differences) == 2:
-                    differences = []
-                if differences:
-                    changes += 1
-                    print (file = report)
-                    print (f"        WARNING: [{hostname}] {key1}", file = report)
-                    print ("        [", end='', file = report)
-                    num_diff = len(differences)
-                    for idx, val1, val2 in differences:
-                        if idx == 1:
-                            print (f"Inodes: {val1} - {val2}", end='', file = report)
-                        elif idx == 2:
-                            print (f"Perms: {val1} - {val2}", end='', file = report)
-                        elif idx == 3:
-                            print (f"Links: {val1} - {val2}", end='', file = report)
-                        elif idx == 4:
-                            print (f"Uid: {val1} - {val2}", end='', file = report)
-                        elif idx == 5:
-                            print (f"Gid: {val1} - {val2}", end='', file = report)
-                        elif idx == 6:
-                            print (f"Size: {val1} - {val2}", end='', file = report)
-                        elif idx == 7:
-                            time1 = strftime('%Y-%m-%d %H:%M:%S', localtime(int(val1)))
-                            time2 = strftime('%Y-%m-%d %H:%M:%S', localtime(int(val2)))
-                            print (f"Ctime: {time1} - {time2}", end='', file = report)
-                        elif idx == 8:
-                            time1 = strftime('%Y-%m-%d %H:%M:%S', localtime(int(val1)))
-                            time2 = strftime('%Y-%m-%d %H:%M:%S', localtime(int(val2)))
-                            print (f"Mtime: {time1} - {time2}", end='', file = report)
-                        elif idx == 9:
-                            time1 = strftime('%Y-%m-%d %H:%M:%S', localtime(int(val1)))
-                            time2 = strftime('%Y-%m-%d %H:%M:%S', localtime(int(val2)))
-                            print (f"Btime: {time1} - {time2}", end='', file = report)
-                        elif idx == 10:
-                            if not os.path.islink(key1):
-                                print (f"Hashes: {val1} - {val2}", end='', file = report)
-                            else:
-                                print (f"Hashes: SYMLINK:{val1} - SYMLINK:{val2}", end='', file = report)
-                        if num_diff > 1:
-                            print (", ", end='', file = report)
-                            num_diff -= 1
-                        else:
-                            print ("]", file = report)
-
-                line1 = get_next_line(reader1)
-                line2 = get_next_line(reader2)
-            elif (key1 < key2 and len(line1) == 11) or len(line1) > len(line2):
-                changes += 1
-                time3 = strftime('%Y-%m-%d %H:%M:%S', localtime(int(line1[9])))
-                print (file = report)
-                print (f"        DELETION: [{hostname}] {key1}", file = report)
-                # pylint: disable=consider-using-f-string
-                print ("        {:<10} {:<12} {:<8} {:<8} {:<8} {:<15} {:<20}".format('Inode','Permissions','NLink','UID','GID','Size','Created On'),
-                        file = report)
-                print ("        {:<10} {:<12} {:<8} {:<8} {:<8} {:<15} {:<20}".format(line1[1],line1[2],line1[3],line1[4],line1[5],line1[6],time3),
-                        file = report)
-                line1 = get_next_line(reader1)
-            else:
-                changes += 1
-                if len(line2) == 1:
-                    if 'BEGIN' in key2:
-                        total_changes += changes
-                        # Print current directory
-                        my_root = line2[0].split(' ')[2].split('-')[0]
-                        print (file = report)
-                        print (f"PROGRESS: Current directory: {my_root}", file = report)
-                        print ("STATUS: ",end='', file = report)
-                        line2 = get_next_line(reader2)
-                        line2 = get_next_line(reader2)
-                        changes = 0
-                        if line2:
-                            key2 = line2[0]
-                    elif 'END' in key2:
-                        line2 = get_next_line(reader2)
-                        if line2:
-                            key2 = line2[0]
-                    continue
-                time3 = strftime('%Y-%m-%d %H:%M:%S', localtime(int(line2[9])))
-                print (file = report)
-                print (f"        ADDITION: [{hostname}] {key2}", file = report)
-                # pylint: disable=consider-using-f-string
-                print ("        {:<10} {:<12} {:<8} {:<8} {:<8} {:<15} {:<20}".format('Inode','Permissions','NLink','UID','GID','Size','Created On'),
-                        file = report)
-                print ("        {:<10} {:<12} {:<8} {:<8} {:<8} {:<15} {:<20}".format(line2[1],line2[2],line2[3],line2[4],line2[5],line2[6],time3),
-                        file = report)
-                line2 = get_next_line(reader2)
-
-        # Process remaining lines in either file
-        while line1:
-            changes += 1
-            if len(line1) == 1:
-                if 'BEGIN' in line1[0]:
-                    total_changes += changes
-                    # Print current directory
-                    my_root = line1[0].split(' ')[2].split('-')[0]
-                    print (file = report)
-                    print (f"PROGRESS: Current directory: {my_root}", file = report)
-                    print ("STATUS: ",end='', file = report)
-                    line1 = get_next_line(reader1)
-                    changes = 0
-                    if line1:
-                        key1 = line1[0]
-                elif 'END' in line1[0]:
-                    line1 = get_next_line(reader1)
-                    if line1:
-                        key1 = line1[0]
-                continue
-            time3 = strftime('%Y-%m-%d %H:%M:%S', localtime(int(line1[9])))
-            print (file = report)
-            print (f"        DELETION: [{hostname}] {key1}", file = report)
-            # pylint: disable=consider-using-f-string
-            print ("        {:<10} {:<12} {:>8} {:>8} {:>8} {:>15} {:<20}".format('Inode','Permissions','NLink','UID','GID','Size','Created On'),
-                    file = report)
-            print ("        {:<10} {:<12} {:>8} {:>8} {:>8} {:>15} {:<20}".format(line1[1],line1[2],line1[3],line1[4],line1[5],line1[6],time3),
-                    file = report)
-            line1 = get_next_line(reader1)
-
-        while line2:
-            changes += 1
-            if len(line2) == 1:
-                if 'BEGIN' in line2[0]:
-                    total_changes += changes
-                    # Print current directory
-                    my_root = line2[0].split(' ')[2].split('-')[0]
-                    print (file = report)
-                    print (f"PROGRESS: Current directory: {my_root}", file = report)
-                    print ("STATUS: ",end='', file = report)
-                    line2 = get_next_line(reader2)
-                    changes = 0
-                    if line1:
-                        key1 = line1[0]
-                elif 'END' in line2[0]:
-                    line2 = get_next_line(reader2)
-                    if line1:
-                        key1 = line1[0]
-                continue
-            time3 = strftime('%Y-%m-%d %H:%M:%S', localtime(int(line2[9])))
-            print (file = report)
-            print (f"        ADDITION: [{hostname}] {key2}", file = report)
-            # pylint: disable=consider-using-f-string
-            print ("        {:<10} {:<12} {:>8} {:>8} {:>8} {:>15} {:<20}".format('Inode','Permissions','NLink','UID','GID','Size','Created On'),
-                    file = report)
-            print ("        {:<10} {:<12} {:>8} {:>8} {:>8} {:>15} {:<20}".format(line2[1],line2[2],line2[3],line2[4],line2[5],line2[6],time3),
-                    file = report)
-            line2 = get_next_line(reader2)
+# package manifest digests are named by length; dpkg only has md5sums
+PACKAGE_DIGESTS = {32: 'md5', 64: 'sha256', 128: 'sha512'}
+
+def load_package_index():
+    """Return {path: (digest name, hex digest)} for dpkg and rpm owned files"""
+
+    index = {}
+    real_dirs = {}
+
+    def add(path, digest):
+        algorithm = PACKAGE_DIGESTS.get(len(digest))
+        if algorithm is None:
+            return
+        dirname, _, basename = path.rpartition('/')
+        real_dir = real_dirs.get(dirname)
+        if real_dir is None:
+            real_dir = real_dirs[dirname] = os.path.realpath(dirname or '/').rstrip('/')
+        index[f"{real_dir}/{basename}"] = (algorithm, digest)
+
+    for manifest in glob.glob('/var/lib/dpkg/info/*.md5sums'):
+        try:
+            with open(manifest, 'r', encoding='utf8', errors='surrogateescape') as file:
+                for line in file:
+                    digest, _, path = line.rstrip('\n').partition('  ')
+                    if path:
+                        add('/' + path, digest)
+        except OSError:
+            continue
+    rpm = shutil.which('rpm')
+    if rpm:
+        # path size mtime digest mode owner group isconfig isdoc rdev symlink
+        try:
+            dump = subprocess.run([rpm, '-qa', '--dump'], capture_output=True, check=True).stdout
+        except (OSError, subprocess.CalledProcessError) as err:
+            print (f"ficheck: rpm -qa --dump failed: {err}", file=sys.stderr)
+            dump = b""
+        for line in dump.decode('utf8', 'surrogateescape').splitlines():
+            fields = line.rsplit(' ', 10)
+            if len(fields) == 11 and fields[7] == '0' and fields[4].startswith('010'):
+                add(fields[0], fields[3])
+    return index
+
+class TeeDigest:
+    """Feed the same data to several digests"""
+
+    def __init__(self, *digests):
+        self.digests = digests
+
+    def update(self, data):
+        """Update every digest"""
+        for digest in self.digests:
+            digest.update(data)
+
+def verify_package(fname, expected, check):
+    """Record fname if check doesn't match its package manifest digest"""
 
-        if changes == 0:
-            print (" passed...", file = report)
-            print (file = report)
+    actual = check.hexdigest()
+    if actual == expected[1]:
+        return True
+    with stats_lock:
+        package_mismatches.append((fname, expected[0], expected[1], actual))
+    return False
+
+class TokenBucket:
+    """Thread-safe token bucket that limits bytes read per second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate / 10, MMAP_CHUNK)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Account for amount bytes read, sleeping if over the rate"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += delay
+        if delay:
+            time.sleep(delay)
+
+def wait_for_load():
+    """Block while the load average is above --max-load"""
+    global load_paused
+
+    if not args.max_load:
+        return
+    start = time.monotonic()
+    while os.getloadavg()[0] > args.max_load:
+        time.sleep(5)
+    load_paused += time.monotonic() - start
+
+def set_priority():
+    """Apply --nice and --ionice to this process"""
+
+    if args.nice:
+        os.nice(args.nice)
+    if args.ionice:
+        ionice = shutil.which('ionice')
+        if not ionice:
+            print ("ficheck: ionice not found, --ionice ignored", file=sys.stderr)
+            return
+        ioclass, _, level = args.ionice.partition(':')
+        ioclass = {'realtime': '1', 'best-effort': '2', 'idle': '3'}.get(ioclass, ioclass)
+        command = [ionice, '-c', ioclass]
+        if level:
+            command += ['-n', level]
+        try:
+            subprocess.run(command + ['-p', str(os.getpid())], check=True)
+        except subprocess.CalledProcessError as err:
+            print (f"ficheck: ionice failed: {err}", file=sys.stderr)
+
+def hash_contents(fname, digest, size):
+    """Feed the contents of fname to digest, mapping files past --mmap-threshold"""
+
+    fd = os.open(fname, os.O_RDONLY)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        mapped = None
+        big_enough = 0 < args.mmap_threshold <= size
+        # a log rotated or truncated since the walk is read instead: its mapping would fault
+        if big_enough and os.fstat(fd).st_size == size:
+            try:
+                mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                mapped = None
+        if mapped is not None:
+            with mapped, memoryview(mapped) as view:
+                for offset in range(0, len(view), MMAP_CHUNK):
+                    if throttle:
+                        throttle.consume(min(MMAP_CHUNK, len(view) - offset))
+                    digest.update(view[offset:offset + MMAP_CHUNK])
+        else:
+            if not hasattr(read_buffers, 'view'):
+                read_buffers.view = memoryview(bytearray(READ_SIZE))
+            view = read_buffers.view
+            with io.FileIO(fd, 'rb', closefd=False) as file:
+                while True:
+                    count = file.readinto(view)
+                    if not count:
+                        break
+                    if throttle:
+                        throttle.consume(count)
+                    digest.update(view[:count])
+        if hasattr(os, 'posix_fadvise') and not args.keep_cache:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
 
-    total_changes += changes
+def count_hashed(fname, size, seconds, tally=None):
+    """Tally a file that was actually read and hashed"""
+    global files_hashed
+    global bytes_hashed
+    global hash_seconds
+
+    with stats_lock:
+        files_hashed += 1
+        bytes_hashed += size
+        hash_seconds += seconds
+        if tally is not None:
+            tally['files_hashed'] += 1
+            tally['bytes_hashed'] += size
+            tally['hash_seconds'] += seconds
+        if args.stats and args.stats_top:
+            if len(slowest_files) < args.stats_top:
+                heapq.heappush(slowest_files, (seconds, size, fname))
+            elif seconds > slowest_files[0][0]:
+                heapq.heapreplace(slowest_files, (seconds, size, fname))
+
+@contextmanager
+def phase(name):
+    """Add the wall and CPU time of a with block to phase_times[name]"""
+
+    wall = time.monotonic()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        times = phase_times.setdefault(name, [0.0, 0.0])
+        times[0] += time.monotonic() - wall
+        times[1] += time.process_time() - cpu
+
+def collect_stats():
+    """Gather the --stats figures of this run into a dict"""
+
+    return {
+        "host": hostname,
+        "timestamp": time.time(),
+        "phases": {name: {"wall_seconds": wall, "cpu_seconds": cpu}
+                   for name, (wall, cpu) in phase_times.items()},
+        "entries_scanned": entries_scanned,
+        "files_hashed": files_hashed,
+        "bytes_hashed": bytes_hashed,
+        "hash_seconds": hash_seconds,
+        "stat_calls": stat_calls,
+        "open_calls": open_calls,
+        "changes": total_changes,
+        "package_files": len(package_index),
+        "package_mismatches": len(package_mismatches),
+        "throttled_seconds": throttle.waited if throttle else 0.0,
+        "load_paused_seconds": load_paused,
+        "roots": root_stats,
+        "slowest_files": [{"path": fname, "size": size, "seconds": seconds}
+                          for seconds, size, fname in sorted(slowest_files, reverse=True)],
+    }
+
+def prometheus_label(value):
+    """Escape a Prometheus label value"""
+
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_prometheus(stats):
+    """Render collect_stats() output for the node_exporter textfile collector"""
+
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append(f"# HELP ficheck_{name} {help_text}")
+        lines.append(f"# TYPE ficheck_{name} gauge")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{prometheus_label(str(val))}"' for key, val in labels.items())
+            lines.append(f"ficheck_{name}{{{label_text}}} {value}" if label_text else f"ficheck_{name} {value}")
+
+    phases = stats["phases"].items()
+    metric("phase_seconds", "Wall clock time per phase of the last run.",
+           [({"phase": name}, times["wall_seconds"]) for name, times in phases])
+    metric("phase_cpu_seconds", "CPU time per phase of the last run.",
+           [({"phase": name}, times["cpu_seconds"]) for name, times in phases])
+    for key, help_text in (("entries_scanned", "Entries stat'ed by the last run."),
+                           ("files_hashed", "Files read and hashed by the last run."),
+                           ("bytes_hashed", "Bytes read and hashed by the last run."),
+                           ("hash_seconds", "Time spent hashing, summed over all jobs."),
+                           ("stat_calls", "stat calls made by the walker."),
+                           ("open_calls", "Directories and files opened by the walker."),
+                           ("changes", "Changes reported by the last run."),
+                           ("package_mismatches", "Files that differ from their package manifest."),
+                           ("throttled_seconds", "Time spent sleeping for --max-rate."),
+                           ("load_paused_seconds", "Time spent paused for --max-load.")):
+        metric(key, help_text, [({}, stats[key])])
+    for key in ("seconds", "entries", "files_hashed", "bytes_hashed"):
+        metric(f"root_{key}", f"Per root {key.replace('_', ' ')} of the last run.",
+               [({"root": root_dir}, figures[key]) for root_dir, figures in stats["roots"].items()])
+    metric("last_run_timestamp_seconds", "Time the last run finished.", [({}, stats["timestamp"])])
+    return "\n".join(lines) + "\n"
+
+def write_stats():
+    """Emit --stats to stderr or --stats-file"""
+
+    stats = collect_stats()
+    if args.stats_format == 'prometheus':
+        text = format_prometheus(stats)
+    else:
+        text = json.dumps(stats, indent=2) + "\n"
+    if not args.stats_file:
+        sys.stderr.write(text)
+        return
+    # write then rename so the textfile collector never sees a partial file
+    tmp_path = args.stats_file + ".tmp"
+    with open(tmp_path, 'w', encoding='utf8') as file:
+        file.write(text)
+    os.replace(tmp_path, args.stats_file)
+
+def print_throughput(elapsed):
+    """Report hashing throughput on stderr"""
+
+    elapsed = max(elapsed, 1e-6)
+    megabytes = bytes_hashed / 1048576
+    print (f"ficheck: {entries_scanned} entries, {files_hashed} files hashed, "
+           f"{megabytes:.1f} MB in {elapsed:.2f}s "
+           f"({files_hashed / elapsed:.1f} files/s, {megabytes / elapsed:.1f} MB/s, "
+           f"{args.jobs} jobs)", file=sys.stderr)
+    if throttle:
+        print (f"ficheck: rate capped at {args.max_rate:g} MB/s, throttled for {throttle.waited:.2f}s",
+               file=sys.stderr)
+    if args.max_load:
+        print (f"ficheck: paused {load_paused:.2f}s for load above {args.max_load:g}", file=sys.stderr)
+    for root_dir, figures in root_stats.items():
+        print (f"ficheck:   {root_dir}: {figures['entries']} entries in {figures['seconds']:.2f}s", file=sys.stderr)
 
 def mode_to_string(mode):
     """convert numeric file permissions to human-readable string"""
@@ -331,48 +1646,77 @@ def mode_to_string(mode):
     mode_str = mode_str + oth_mode
     return mode_str
 
-def process_entry(fname):
+STATX_TYPES = {'FIFO': S_IFIFO, 'character special file': S_IFCHR, 'directory': S_IFDIR,
+               'block special file': S_IFBLK, 'regular file': S_IFREG,
+               'symbolic link': S_IFLNK, 'socket': S_IFSOCK}
+
+# the lstat() fields process_entry() uses, plus st_btime, from one statx() call
+StatxResult = namedtuple("StatxResult", "st_mode st_ino st_nlink st_uid st_gid st_size "
+                                        "st_atime st_mtime st_ctime st_btime")
+
+def lstat_entry(fname):
+    """lstat() fname, getting the birth time in the same call when statx is available"""
+
+    if not have_statx:
+        return os.lstat(fname)
+    result = statx.statx(fname, follow_symlinks=False)
+    # the wrapper doesn't report errors, it just leaves every field unset
+    if not result.mask:
+        raise OSError(f"statx failed: {fname}")
+    return StatxResult(STATX_TYPES.get(result.filetype, 0) | result.mode, result.ino,
+                       result.nlink, result.uid, result.gid, result.size,
+                       result.atime, result.mtime, result.ctime, result.btime)
+
+def process_entry(fname, status=None, is_dir=None, tally=None):
     """Gather info about file (or directory) to add to db"""
 
-    sha256 = hashlib.sha256()
-    try:
-        if os.path.islink(fname):
-            status = os.lstat(fname)
-        else:
-            status = os.stat(fname)
-    except IOError:
-        return
+    digest = DIGESTS[args.digest]()
+    if status is None:
+        try:
+            status = lstat_entry(fname)
+        except OSError:
+            return None
+    if is_dir is None:
+        is_dir = S_ISDIR(status.st_mode) or (S_ISLNK(status.st_mode) and os.path.isdir(fname))
     fname_out = fname
+    # pylint: disable=consider-using-f-string
+    mtime = "{:10.0f}".format(status.st_mtime)
+    #atime = "{:10.0f}".format(status.st_atime)
+    ctime = "{:10.0f}".format(status.st_ctime)
     try:
         if status.st_size == 0:
             sha256str = "0"
-        elif os.path.isdir(fname):
+        elif is_dir:
             sha256str = "Dir"
         elif S_ISBLK(status.st_mode) or S_ISCHR(status.st_mode) or S_ISFIFO(status.st_mode):
             sha256str= "Device"
-        elif os.path.islink(fname):
-            sha256.update(os.readlink(fname).encode())
-            sha256str = sha256.hexdigest()
-        elif status.st_size > 0 and os.path.isfile(fname):
-            with open(fname, "rb") as f:
+        elif S_ISLNK(status.st_mode):
+            digest.update(os.readlink(fname).encode())
+            sha256str = digest.hexdigest()
+        elif S_ISREG(status.st_mode):
+            sha256str = reuse_hash(fname, status, ctime, mtime) if baseline else None
+            if sha256str is None:
                 if status.st_size > args.size:
                     sha256str = "0"
                 else:
-                    for block in iter(lambda: f.read(65536), b""):
-                        sha256.update(block)
-                    sha256str = sha256.hexdigest()
+                    package = package_index.get(fname) if package_index else None
+                    check = hashlib.new(package[0]) if package else None
+                    start = time.perf_counter()
+                    hash_contents(fname, TeeDigest(digest, check) if check else digest, status.st_size)
+                    sha256str = digest.hexdigest()
+                    count_hashed(fname, status.st_size, time.perf_counter() - start, tally)
+                    if check and verify_package(fname, package, check) and args.package_hash:
+                        sha256str = "Pkg"
         else:
             sha256str = "0"
     except IOError:
         sha256str = "0"
     mode = mode_to_string(status.st_mode)
-    # pylint: disable=consider-using-f-string
-    mtime = "{:10.0f}".format(status.st_mtime)
-    #atime = "{:10.0f}".format(status.st_atime)
-    ctime = "{:10.0f}".format(status.st_ctime)
     if have_statx:
+        # a symlink's btime has always been its target's
+        btime = statx.statx(fname).btime if S_ISLNK(status.st_mode) else status.st_btime
         try:
-            btime = "{:10.0f}".format(statx.statx(fname).btime)
+            btime = "{:10.0f}".format(btime)
         except TypeError:
             btime = 0
     else:
@@ -382,40 +1726,549 @@ def process_entry(fname):
     gid = status.st_gid
     inode = status.st_ino
     links = status.st_nlink
-    write_file(fname_out, inode, mode, links, uid, gid, size, ctime, mtime, btime, sha256str)
+    return [fname_out, inode, mode, links, uid, gid, size, ctime, mtime, btime, sha256str]
 
-def walk_directory_tree(dirs, paths):
-    """Walk through the directories configured in config file"""
+class Exclusions:
+    """Compiled Exclusion entries, tested with `path in exclusions`"""
+
+    def __init__(self, paths):
+        self.exact = set()
+        by_dir = {}
+        anywhere = []
+        for path in paths:
+            if not any(char in path for char in '*?['):
+                self.exact.add(path)
+                continue
+            dirname, _, basename = path.rpartition('/')
+            if any(char in dirname for char in '*?['):
+                anywhere.append(fnmatch.translate(path))
+            else:
+                by_dir.setdefault(dirname, []).append(fnmatch.translate(basename))
+        self.by_dir = {dirname: re.compile("|".join(patterns)) for dirname, patterns in by_dir.items()}
+        self.anywhere = re.compile("|".join(anywhere)) if anywhere else None
+
+    def __contains__(self, path):
+        if path in self.exact:
+            return True
+        if self.by_dir:
+            dirname, _, basename = path.rpartition('/')
+            pattern = self.by_dir.get(dirname)
+            if pattern is not None and pattern.match(basename):
+                return True
+        return self.anywhere is not None and self.anywhere.match(path) is not None
+
+def scan_tree(root_dir, paths, tally=None, stack=None, boundaries=False):
+    """Yield (path, lstat result, is_dir) for everything under root_dir in walk order"""
+
+    stack = [root_dir] if stack is None else list(stack)
+    while stack:
+        # everything before this point has been yielded; stack is live, so copy it to keep it
+        if boundaries:
+            yield None, stack, None
+        dirpath = stack.pop()
+        wait_for_load()
+        dirs = []
+        files = []
+        try:
+            with os.scandir(dirpath) as scan:
+                for entry in scan:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    (dirs if is_dir else files).append((entry.name, entry.path, is_dir, entry))
+        except OSError:
+            continue
+        if tally is not None:
+            tally['directories'] += 1
+            tally['stat_calls'] += sum(1 for item in itertools.chain(dirs, files) if item[3].is_symlink())
+        dirs.sort()
+        files.sort()
+        # Only the top level of / is monitored, files first
+        if root_dir == "/":
+            files = files + dirs
+            dirs = []
+        # Skip directories specified in skip_paths
+        dirs = [item for item in dirs if item[1] not in paths]
+
+        for _, file_path, is_dir, entry in itertools.chain(dirs, files):
+            if file_path in paths:
+                continue
+            if tally is not None:
+                tally['stat_calls'] += 1
+            try:
+                status = lstat_entry(file_path)
+            except OSError:
+                continue
+            yield file_path, status, is_dir
+
+        stack.extend(reversed([item[1] for item in dirs if not item[3].is_symlink()]))
+
+def scan_root(root_dir, paths, pool, emit, stack=None, tally=None):
+    """Scan one configured Directory, handing rows to emit in walk order"""
+    global entries_scanned
+    global stat_calls
+    global open_calls
+
+    pending = deque()
+    window = args.jobs * 16
+    if tally is None:
+        tally = {'seconds': 0.0, 'entries': 0, 'directories': 0, 'stat_calls': 0,
+                 'files_hashed': 0, 'bytes_hashed': 0, 'hash_seconds': 0.0}
+    count = tally['entries']
+
+    def drain(limit=0):
+        while len(pending) > limit:
+            row = pending.popleft().result()
+            if row:
+                emit(row)
+
+    start = time.monotonic()
+    for file_path, status, is_dir in scan_tree(root_dir, paths, tally, stack, checkpoint_path is not None):
+        if file_path is None:
+            # status is the walker's stack of directories still to read
+            if time.monotonic() >= next_checkpoint:
+                drain()
+                tally['entries'] = count
+                write_checkpoint(root_dir, status, tally)
+            continue
+        count += 1
+        if pool is None:
+            row = process_entry(file_path, status, is_dir, tally)
+            if row:
+                emit(row)
+        else:
+            pending.append(pool.submit(process_entry, file_path, status, is_dir, tally))
+            drain(window)
+    drain()
+    with stats_lock:
+        entries_scanned += count
+        stat_calls += tally['stat_calls']
+        open_calls += tally['directories'] + tally['files_hashed']
+        tally['seconds'] += time.monotonic() - start
+        tally['entries'] = count
+        root_stats[root_dir] = tally
 
+def device_groups(dirs):
+    """Group root directories by the device they live on, keeping config order"""
+
+    groups = {}
     for root_dir in dirs:
+        try:
+            device = os.stat(root_dir).st_dev
+        except OSError:
+            device = None
+        groups.setdefault(device, []).append(root_dir)
+    return list(groups.values())
+
+def acquire_lock(path):
+    """Take an exclusive lock on path, exiting if another run holds it"""
+
+    fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print (f"ficheck: another run holds {path}", file=sys.stderr)
+        sys.exit(255)
+    os.ftruncate(fd, 0)
+    os.write(fd, f"{os.getpid()}\n".encode())
+    return fd
+
+def write_checkpoint(root_dir, stack, tally):
+    """Save how far the walk has got, for --resume"""
+    global next_checkpoint
+
+    # sync() puts the rows up to offset on disk before the checkpoint refers to them
+    state = dict(checkpoint_state, root=root_dir, stack=list(stack), offset=db_writer.sync(),
+                 tally=tally, root_stats=root_stats, slowest_files=slowest_files,
+                 package_mismatches=package_mismatches,
+                 counters=[files_hashed, bytes_hashed, hash_seconds, entries_scanned,
+                           stat_calls, open_calls])
+    tmp_path = checkpoint_path + ".tmp"
+    fd = os.open(tmp_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w', encoding='utf8', errors='surrogateescape') as file:
+        json.dump(state, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, checkpoint_path)
+    next_checkpoint = time.monotonic() + args.checkpoint_interval
+
+def load_checkpoint(state):
+    """Return the saved checkpoint if it belongs to a run like this one"""
+
+    try:
+        with open(checkpoint_path, 'r', encoding='utf8', errors='surrogateescape') as file:
+            saved = json.load(file)
+        part_size = os.path.getsize(new_db_file_path + ".part")
+    except (OSError, ValueError):
+        return None
+    for key in ('version', 'config', 'roots', 'digest', 'format', 'size', 'incremental',
+                'packages', 'package_hash'):
+        if saved.get(key) != state[key]:
+            return None
+    if saved['root'] not in state['roots'] or part_size < saved['offset']:
+        return None
+    return saved
+
+def restore_checkpoint(saved):
+    """Put back the package mismatches and stats saved with a checkpoint"""
+
+    global files_hashed
+    global bytes_hashed
+    global hash_seconds
+    global entries_scanned
+    global stat_calls
+    global open_calls
+
+    (files_hashed, bytes_hashed, hash_seconds, entries_scanned,
+     stat_calls, open_calls) = saved['counters']
+    root_stats.update(saved['root_stats'])
+    slowest_files.extend(tuple(item) for item in saved['slowest_files'])
+    heapq.heapify(slowest_files)
+    package_mismatches.extend(tuple(item) for item in saved['package_mismatches'])
+
+def walk_directory_tree(dirs, paths, resume=None):
+    """Walk through the directories configured in config file"""
+
+    pool = ThreadPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+    start = time.monotonic()
+    groups = device_groups(dirs) if args.parallel_roots else [dirs]
+    if len(groups) == 1:
+        first = dirs.index(resume['root']) if resume else 0
+        for root_dir in dirs[first:]:
+            if resume and root_dir == resume['root']:
+                scan_root(root_dir, paths, pool, db_writer.row, resume['stack'], resume['tally'])
+                continue
+            db_writer.begin_directory(root_dir)
+            scan_root(root_dir, paths, pool, db_writer.row)
+    else:
+        spools = {}
+
+        def scan_group(roots):
+            for root_dir in roots:
+                # pylint: disable=consider-using-with
+                spool = tempfile.TemporaryFile('w+', newline='', encoding='utf8',
+                                               dir=os.path.dirname(new_db_file_path))
+                scan_root(root_dir, paths, pool, csv.writer(spool, delimiter='&').writerow)
+                spool.seek(0)
+                spools[root_dir] = spool
+
+        with ThreadPoolExecutor(max_workers=len(groups)) as root_pool:
+            for future in [root_pool.submit(scan_group, roots) for roots in groups]:
+                future.result()
+        for root_dir in dirs:
+            db_writer.begin_directory(root_dir)
+            with spools[root_dir] as spool:
+                for row in csv.reader(spool, delimiter='&'):
+                    db_writer.row(row)
+
+    if pool is not None:
+        pool.shutdown()
+    db_writer.end_directories()
+    if args.throughput:
+        print_throughput(time.monotonic() - start)
+
+def rescan_targets(dirs, paths):
+    """Resolve --root and --only into {root: [subtrees]}"""
+
+    targets = {}
+    for requested in args.root or []:
+        # match /etc against Directory=/etc/ but key on the configured spelling
+        roots = [root_dir for root_dir in dirs if os.path.abspath(root_dir) == os.path.abspath(requested)]
+        if not roots:
+            print (f"ficheck: {requested} is not a Directory in {args.config}", file=sys.stderr)
+            sys.exit(255)
+        targets[roots[0]] = []
+    for path in args.only or []:
+        path = os.path.abspath(path)
+        roots = [root_dir for root_dir in dirs
+                 if path.startswith(root_dir.rstrip('/') + '/') and (root_dir != '/' or path.count('/') == 1)]
+        if not roots:
+            print (f"ficheck: {path} is not below a Directory in {args.config}", file=sys.stderr)
+            sys.exit(255)
+        root_dir = max(roots, key=len)
+        parent = path
+        while parent != root_dir:
+            if parent in paths:
+                print (f"ficheck: {path} is excluded", file=sys.stderr)
+                sys.exit(255)
+            parent = os.path.dirname(parent)
+        if targets.get(root_dir, None) != []:
+            targets.setdefault(root_dir, []).append(path)
+    for root_dir, subtrees in targets.items():
+        # drop subtrees inside other subtrees, they are rescanned anyway
+        subtrees.sort()
+        kept = []
+        for path in subtrees:
+            if not kept or not path.startswith(kept[-1] + '/') and path != kept[-1]:
+                kept.append(path)
+        targets[root_dir] = kept
+    return targets
+
+def rescan_subtrees(root_dir, subtrees, old_rows, paths, pool):
+    """Yield the rows of one section with subtrees rescanned"""
+
+    def key(row):
+        return walk_key(root_dir, row)
 
-        # pylint: disable=redefined-outer-name
-        with open(new_db_file_path, "a", encoding='utf8') as db:
-            print (f"#-----------------BEGIN DIRECTORY {root_dir}--------------------", file=db)
+    new_rows = []
+    for path in subtrees:
+        row = process_entry(path)
+        if row is None:
+            continue
+        new_rows.append(row)
+        if os.path.isdir(path) and not os.path.islink(path) and root_dir != '/':
+            scan_root(path, paths, pool, new_rows.append)
+    new_rows.sort(key=key)
+    prefixes = tuple(path + '/' for path in subtrees)
+    old_rows = (row for row in old_rows if row[0] not in subtrees and not row[0].startswith(prefixes))
+    yield from heapq.merge(old_rows, new_rows, key=key)
 
-        for dirpath, dirnames, filenames in os.walk(root_dir):
-            dirnames.sort()
-            filenames.sort()
-            # Skip directories specified in skip_paths
-            if root_dir == "/":
-                filenames = filenames + dirnames
-                del dirnames[:]
-            dirnames[:] = [d for d in dirnames if os.path.abspath(os.path.join(dirpath, d)) not in paths]
+def rescan_db(dirs, paths, targets):
+    """Write the new db as a copy of the old one with targets rescanned"""
 
-            # Create entry for file that isn't skipped
-            for filename in itertools.chain(dirnames,filenames):
-                file_path = os.path.abspath(os.path.join(dirpath, filename))
-                if file_path not in paths:
-                    process_entry(file_path)
+    pool = ThreadPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else None
+    reader = SectionReader(old_db_file_path)
+    old_roots = db_sections(old_db_file_path)
+    for root_dir in dirs + [root for root in old_roots if root not in dirs]:
+        subtrees = targets.get(root_dir)
+        if subtrees is None and root_dir not in old_roots:
+            continue
+        db_writer.begin_directory(root_dir)
+        if subtrees is None:
+            for row in reader.rows(root_dir):
+                db_writer.row(row)
+        elif not subtrees or root_dir not in old_roots:
+            scan_root(root_dir, paths, pool, db_writer.row)
+        else:
+            for row in rescan_subtrees(root_dir, subtrees, reader.rows(root_dir), paths, pool):
+                db_writer.row(row)
+    if pool is not None:
+        pool.shutdown()
+    db_writer.end_directories()
+
+class Inotify:
+    """Minimal ctypes binding for the Linux inotify API"""
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                  | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify not available")
+        self.fd = self.libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.watches = {}
+
+    def add_watch(self, path):
+        """Watch one directory"""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.watches[wd] = path
+
+    def read_events(self, timeout):
+        """Return a list of (mask, path) for events within timeout seconds"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((mask, None))
+                continue
+            directory = self.watches.get(wd)
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if directory is not None:
+                events.append((mask, os.path.join(directory, name) if name else directory))
+        return events
+
+    def close(self):
+        """Release the inotify descriptor"""
+        os.close(self.fd)
+
+class Monitor:
+    """Continuous monitoring of the configured roots with inotify (--daemon)"""
+
+    def __init__(self, dirs, paths, entries, out):
+        self.dirs = dirs
+        self.paths = paths
+        self.entries = entries
+        self.renderer = RENDERERS[args.format](out)
+        self.out = out
+        self.inotify = None
 
-    with open(new_db_file_path, "a", encoding='utf8') as db:
-        print ("#-----------------END DIRECTORIES--------------------", file=db)
+    def root_of(self, path):
+        """Return the configured root a path is monitored under, or None"""
+        best = None
+        for root_dir in self.dirs:
+            if root_dir == '/':
+                if path.count('/') == 1 and path != '/':
+                    best = best or root_dir
+            elif path.startswith(root_dir + '/') and (best is None or len(root_dir) > len(best)):
+                best = root_dir
+        return best
+
+    def excluded(self, path):
+        """Is path, or a directory above it, excluded?"""
+        while path not in ('/', ''):
+            if path in self.paths:
+                return True
+            path = os.path.dirname(path)
+        return False
+
+    def watch_tree(self, top):
+        """Add watches for top and every directory below it"""
+        self.inotify.add_watch(top)
+        if top == '/':
+            return
+        for file_path, status, _ in scan_tree(top, self.paths):
+            if S_ISDIR(status.st_mode):
+                self.inotify.add_watch(file_path)
+
+    def add_watch(self, path):
+        """Watch one directory found after start up, ignoring failures"""
+        try:
+            self.inotify.add_watch(path)
+        except OSError:
+            pass
+
+    def emit(self, item):
+        """Print one change and keep the baseline in step with it"""
+        if item.kind == 'deleted':
+            self.entries.pop(item.path, None)
+        elif item.new is not None:
+            self.entries[item.path] = item.new
+        self.renderer.change(item)
+        self.out.flush()
+
+    def check_entry(self, root_dir, path, status, is_dir=None):
+        """Compare one stat'ed entry with the baseline and report any change"""
+        new = process_entry(path, status, is_dir)
+        if new is None:
+            return
+        new = [str(value) for value in new]
+        old = self.entries.get(path)
+        if old is None:
+            self.emit(Change('added', root_dir, path, None, new, None))
+        else:
+            fields = diff_rows(old, new, True)
+            if fields:
+                self.emit(Change('modified', root_dir, path, old, new, fields))
+
+    def check_path(self, path):
+        """Re-stat one path and report how it differs from the baseline"""
+        root_dir = self.root_of(path)
+        if root_dir is None or self.excluded(path):
+            return
+        try:
+            status = lstat_entry(path)
+        except OSError:
+            status = None
+        if status is None:
+            old = self.entries.get(path)
+            if old is not None:
+                self.emit(Change('deleted', root_dir, path, old, None, None))
+            prefix = path + '/'
+            for child in [p for p in self.entries if p.startswith(prefix)]:
+                self.emit(Change('deleted', root_dir, child, self.entries[child], None, None))
+            return
+        self.check_entry(root_dir, path, status)
+        if S_ISDIR(status.st_mode) and root_dir != '/' and self.inotify is not None:
+            # anything created before the watch existed would be missed
+            self.add_watch(path)
+            for file_path, child_status, is_dir in scan_tree(path, self.paths):
+                if S_ISDIR(child_status.st_mode):
+                    self.add_watch(file_path)
+                self.check_entry(self.root_of(file_path), file_path, child_status, is_dir)
+
+    def full_scan(self):
+        """Rescan every root and report differences from the baseline"""
+        seen = set()
+        for root_dir in self.dirs:
+            for file_path, status, is_dir in scan_tree(root_dir, self.paths):
+                seen.add(file_path)
+                self.check_entry(root_dir, file_path, status, is_dir)
+        for path in [p for p in self.entries if p not in seen]:
+            self.emit(Change('deleted', self.root_of(path), path, self.entries[path], None, None))
+
+    def setup_watches(self):
+        """Try to watch every root, falling back to polling on failure"""
+        try:
+            self.inotify = Inotify()
+            for root_dir in self.dirs:
+                self.watch_tree(root_dir)
+        except OSError as err:
+            print (f"ficheck: inotify unavailable ({err}), falling back to full scans", file=sys.stderr)
+            if self.inotify is not None:
+                self.inotify.close()
+            self.inotify = None
+
+    def run(self):
+        """Watch for changes until interrupted"""
+        self.setup_watches()
+        interval = args.rescan_interval or (0 if self.inotify else 3600)
+        next_scan = time.monotonic() + interval if interval else None
+        while True:
+            if self.inotify is None:
+                time.sleep(max(0, next_scan - time.monotonic()))
+                events = []
+            else:
+                timeout = None if next_scan is None else max(0, next_scan - time.monotonic())
+                events = self.inotify.read_events(timeout)
+                # let a burst of writes settle into one check per path
+                if events:
+                    time.sleep(0.1)
+                    while True:
+                        more = self.inotify.read_events(0)
+                        if not more:
+                            break
+                        events.extend(more)
+            if any(path is None for _, path in events):
+                print ("ficheck: inotify queue overflowed, rescanning", file=sys.stderr)
+                self.inotify.close()
+                self.setup_watches()
+                self.full_scan()
+            else:
+                for path in dict.fromkeys(path for _, path in events):
+                    self.check_path(path)
+            if next_scan is not None and time.monotonic() >= next_scan:
+                self.full_scan()
+                next_scan = time.monotonic() + interval
 
 def parse_config_file(config_file):
     """Pare config file"""
 
     my_root_dirs = []
     my_skip_paths = []
+    my_settings = {}
     if not os.path.exists(config_file):
         print (f"{os.strerror(errno.ENOENT)}: {config_file}")
         sys.exit(255)
@@ -429,8 +2282,10 @@ def parse_config_file(config_file):
                 my_root_dirs.append(os.path.abspath(value))
             elif key.lower() == 'exclusion':
                 my_skip_paths.append(os.path.abspath(value))
+            else:
+                my_settings[key.lower()] = value
     my_root_dirs = [item for item in my_root_dirs if item not in my_skip_paths]
-    return my_root_dirs, my_skip_paths
+    return my_root_dirs, my_skip_paths, my_settings
 
 def move_file(file1, file2):
     """If update switch passed, move new db into old db location"""
@@ -439,9 +2294,20 @@ def move_file(file1, file2):
         sys.exit(1)
     parts = os.path.split(file1)
     Path(parts[0]).mkdir(parents=True, exist_ok=True)
-    if os.path.isfile(file1):
-        os.remove(file1)
-    shutil.move(file2, file1)
+    try:
+        os.replace(file2, file1)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        # /run is usually tmpfs, so copy next to the old db and rename there
+        tmp_path = file1 + ".tmp"
+        fd = os.open(tmp_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+        with open(file2, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, file1)
+        os.remove(file2)
 
 if __name__ == "__main__":
     signal.signal(signal.SIGPIPE, signal.SIG_DFL)
@@ -469,6 +2335,21 @@ if __name__ == "__main__":
         help="update database",
         default=False
     )
+    parser.add_argument(
+        '--db',
+        metavar="PATH",
+        help=f"baseline db (default = {old_db_file_path})"
+    )
+    parser.add_argument(
+        '--new-db',
+        metavar="PATH",
+        help=f"db written by this run before it replaces the baseline (default = {new_db_file_path})"
+    )
+    parser.add_argument(
+        '--report-file',
+        metavar="PATH",
+        help=f"report spool file (default = {report_file_path})"
+    )
     parser.add_argument(
         "-V",
         "--version",
@@ -484,57 +2365,460 @@ if __name__ == "__main__":
         default=False,
         help="produce a report"
     )
+    parser.add_argument(
+        '--format',
+        choices=sorted(RENDERERS),
+        help="report format (default = text)",
+        default='text'
+    )
+    parser.add_argument(
+        '--golden',
+        metavar="PATH",
+        help="compare this scan with the golden db PATH instead of the old db"
+    )
+    parser.add_argument(
+        '--golden-mask',
+        metavar="FIELDS",
+        help="with --golden, fields not compared (default = inode,links,ctime,mtime,btime)",
+        default="inode,links,ctime,mtime,btime"
+    )
+    parser.add_argument(
+        '--packages',
+        action='store_true',
+        default=False,
+        help="check hashed files owned by dpkg/rpm packages against the package manifests"
+    )
+    parser.add_argument(
+        '--package-hash',
+        action='store_true',
+        default=False,
+        help="with --packages, store Pkg instead of a hash for files that match their package"
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        default=False,
+        help="with -r, write the report to stdout as it is produced instead of via the report file"
+    )
+    parser.add_argument(
+        '--max-per-dir',
+        metavar="N",
+        type=int,
+        help="report at most N changes per directory and summarize the rest (default = 0, no limit)",
+        default=0
+    )
+    parser.add_argument(
+        '-i',
+        '--incremental',
+        action='store_true',
+        default=False,
+        help="reuse hashes from the old db for files whose inode, size, ctime and mtime are unchanged"
+    )
+    parser.add_argument(
+        '--rehash-days',
+        metavar="DAYS",
+        type=int,
+        help="with -i, force a full rehash if the last one is older than DAYS days (default = 0, never)",
+        default=0
+    )
+    parser.add_argument(
+        '--sample',
+        metavar="PCT",
+        type=float,
+        help="with -i, rehash a random PCT percent of unchanged files anyway (default = 0)",
+        default=0
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        metavar="JOBS",
+        type=int,
+        help="number of files to hash concurrently (default = 1)",
+        default=1
+    )
+    parser.add_argument(
+        '--throughput',
+        action='store_true',
+        default=False,
+        help="print files/s and MB/s hashed to stderr, with per-root timings"
+    )
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        default=False,
+        help="report per-phase timings, counters and the slowest files to stderr or --stats-file"
+    )
+    parser.add_argument(
+        '--stats-format',
+        choices=['json', 'prometheus'],
+        help="format of --stats (default = json)",
+        default='json'
+    )
+    parser.add_argument(
+        '--stats-file',
+        metavar="PATH",
+        help="write --stats to PATH instead of stderr, e.g. for the node_exporter textfile collector"
+    )
+    parser.add_argument(
+        '--stats-top',
+        metavar="N",
+        type=int,
+        help="number of slowest files to hash listed by --stats (default = 10)",
+        default=10
+    )
+    parser.add_argument(
+        '--profile',
+        metavar="FILE",
+        help="run under cProfile and dump pstats to FILE (main thread only)"
+    )
+    parser.add_argument(
+        '--root',
+        metavar="PATH",
+        action='append',
+        help="rescan only this configured Directory and keep the rest of the old db (may be repeated)"
+    )
+    parser.add_argument(
+        '--only',
+        metavar="PATH",
+        action='append',
+        help="rescan only this path and everything below it and keep the rest of the old db (may be repeated)"
+    )
+    parser.add_argument(
+        '--checkpoint-interval',
+        metavar="SECONDS",
+        type=float,
+        help="save walk progress for --resume this often (default = 60, 0 = never)",
+        default=60
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help="carry on from the last checkpoint of an interrupted run, if there is one"
+    )
+    parser.add_argument(
+        '--parallel-roots',
+        action='store_true',
+        default=False,
+        help="scan roots on different devices concurrently"
+    )
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        default=False,
+        help="watch the roots with inotify and report changes to the baseline as they happen"
+    )
+    parser.add_argument(
+        '--rescan-interval',
+        metavar="SECONDS",
+        type=float,
+        help="with --daemon, also do a full scan this often (default = 0, only on queue overflow)",
+        default=0
+    )
+    parser.add_argument(
+        '--buffer-size',
+        metavar="BYTES",
+        type=int,
+        help="write buffer for the new db (default = 1048576)",
+        default=1048576
+    )
+    parser.add_argument(
+        '--db-format',
+        choices=['text', 'binary'],
+        help="format of the db written by this run (default = text)",
+        default='text'
+    )
+    parser.add_argument(
+        '--convert',
+        nargs=2,
+        metavar=('IN', 'OUT'),
+        help="convert db IN to --db-format and write it to OUT"
+    )
+    parser.add_argument(
+        '--lookup',
+        metavar="PATH",
+        help="print the old db entry for a single path"
+    )
+    parser.add_argument(
+        '--root-digest',
+        action='store_true',
+        help="print the directory digest of the whole old db and exit"
+    )
+    parser.add_argument(
+        '--digest',
+        choices=['sha256', 'blake2b', 'sha512_256', 'blake3'],
+        help="hash algorithm (default = Digest from the config file, or sha256); blake3 needs the blake3 module"
+    )
+    parser.add_argument(
+        '--mmap-threshold',
+        metavar="BYTES",
+        type=int,
+        help="hash files at least this big through mmap rather than read() (default = 0, never)",
+        default=0
+    )
+    parser.add_argument(
+        '--keep-cache',
+        action='store_true',
+        default=False,
+        help="don't drop hashed files from the page cache"
+    )
+    parser.add_argument(
+        '--nice',
+        metavar="N",
+        type=int,
+        help="add N to the process nice value",
+        default=0
+    )
+    parser.add_argument(
+        '--ionice',
+        metavar="CLASS[:LEVEL]",
+        help="I/O scheduling class (idle, best-effort or realtime, optionally with a level 0-7)"
+    )
+    parser.add_argument(
+        '--max-rate',
+        metavar="MB",
+        type=float,
+        help="cap hashing reads at MB megabytes per second",
+        default=0
+    )
+    parser.add_argument(
+        '--max-load',
+        metavar="LOAD",
+        type=float,
+        help="pause the walk while the 1 minute load average is above LOAD",
+        default=0
+    )
+    parser.add_argument(
+        '--sqlite',
+        action='store_true',
+        default=False,
+        help="with -u, also record this scan in the SQLite history"
+    )
+    parser.add_argument(
+        '--sqlite-db',
+        metavar="PATH",
+        help=f"SQLite history store (default = {sqlite_db_file_path})"
+    )
+    parser.add_argument(
+        '--history',
+        metavar="PATH",
+        help="print the SQLite history of a single path"
+    )
+    parser.add_argument(
+        '--changed-since',
+        metavar="DAYS",
+        type=float,
+        help="print paths changed in the last DAYS days"
+    )
+    parser.add_argument(
+        '--find-hash',
+        metavar="HASH",
+        help="print every path ever recorded with hash HASH"
+    )
 
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("jobs must be >= 1")
+    if args.buffer_size < 1:
+        parser.error("buffer size must be >= 1")
+    if args.max_rate < 0:
+        parser.error("max rate must be >= 0")
+    if args.stats_top < 0:
+        parser.error("stats top must be >= 0")
+    if args.max_per_dir < 0:
+        parser.error("max per dir must be >= 0")
+    if args.package_hash and not args.packages:
+        parser.error("--package-hash needs --packages")
+    if args.golden:
+        try:
+            compared_fields = tuple(idx for idx in range(1, 11) if idx not in parse_field_mask(args.golden_mask))
+        except ValueError as err:
+            parser.error(str(err))
+        if not os.path.exists(args.golden):
+            parser.error(f"golden db {args.golden} not found")
+    if args.db:
+        old_db_file_path = os.path.abspath(args.db)
+    if args.new_db:
+        new_db_file_path = os.path.abspath(args.new_db)
+    if args.report_file:
+        report_file_path = os.path.abspath(args.report_file)
+    if args.sqlite_db:
+        sqlite_db_file_path = os.path.abspath(args.sqlite_db)
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        def dump_profile():
+            """Stop profiling and write the pstats file"""
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        atexit.register(dump_profile)
+
+    if args.convert:
+        convert_db(*args.convert)
+        sys.exit(0)
+    if args.lookup:
+        found_entry = lookup_db(old_db_file_path, os.path.abspath(args.lookup))
+        if found_entry is None:
+            print (f"{args.lookup}: not in {old_db_file_path}", file=sys.stderr)
+            sys.exit(1)
+        csv.writer(sys.stdout, delimiter='&', lineterminator='\n').writerow(found_entry)
+        sys.exit(0)
+    if args.root_digest:
+        root_tree = load_tree(old_db_file_path) or build_tree(old_db_file_path)
+        print (root_tree[0])
+        sys.exit(0)
+    if args.history or args.changed_since is not None or args.find_hash:
+        query_sqlite(sqlite_db_file_path)
+        sys.exit(0)
 
     root_dirs = []
     skip_paths = []
 
     if args.config:
-        config_root_dirs, config_skip_paths = parse_config_file(args.config)
+        config_root_dirs, config_skip_paths, config_settings = parse_config_file(args.config)
         root_dirs.extend(config_root_dirs)
         skip_paths.extend(config_skip_paths)
         skip_paths.extend(['/proc/','/sys/'])
+        if args.digest is None:
+            args.digest = config_settings.get('digest', DEFAULT_DIGEST).lower()
+    if args.digest is None:
+        args.digest = DEFAULT_DIGEST
+    if args.digest not in DIGESTS:
+        parser.error(f"digest {args.digest} is not available, choose from {', '.join(DIGESTS)}")
 
-    if args.report:
-        fd = os.open(report_file_path, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o600)
-        report = os.fdopen(fd, 'w+', encoding='utf-8')
-
-    fd = os.open(new_db_file_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
-    with os.fdopen(fd, 'w+', newline='', encoding='utf-8') as db:
-        writer = csv.writer(db, delimiter='&')
-    with open(new_db_file_path, "a", encoding='utf8') as db:
-        if os.name == "posix":
-            sys_info = os.uname()
-        curr_time = datetime.now(timezone.utc).isoformat()
-        print (f"# - - Host     {hostname}", file=db)
-        print (f"# - - OS       {sys_info.sysname} {sys_info.release}", file=db)
-        print (f"# - - Creation {curr_time}", file=db)
-        print (f"# - - Uname    {sys_info.sysname} {hostname} {sys_info.release} {sys_info.version} {sys_info.machine}", file=db)
-        print ("# - - Ficheck by Jim Clausing, ideas freely stolen from FCheck perl script by Michael A. Gumienny", file=db)
-
-    if not os.path.exists(old_db_file_path):
+    set_priority()
+    if args.max_rate:
+        throttle = TokenBucket(args.max_rate * 1048576)
+
+    if args.daemon:
+        if not os.path.exists(old_db_file_path):
+            print (f"ficheck: no baseline at {old_db_file_path}, run with -u first", file=sys.stderr)
+            sys.exit(255)
+        old_entries, old_header = load_baseline(old_db_file_path)
+        if old_header.get('Digest', DEFAULT_DIGEST) != args.digest:
+            print (f"ficheck: baseline uses {old_header.get('Digest', DEFAULT_DIGEST)}, not {args.digest}",
+                   file=sys.stderr)
+            sys.exit(255)
+        if args.incremental:
+            baseline = old_entries
+            racy_after = scan_second(old_header)
+        try:
+            Monitor(root_dirs, Exclusions(os.path.abspath(p) for p in skip_paths),
+                    old_entries, sys.stdout).run()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    lock_file = acquire_lock(new_db_file_path + ".lock")
+
+    rescan = None
+    if args.root or args.only:
+        if not os.path.exists(old_db_file_path):
+            print (f"ficheck: no baseline at {old_db_file_path}, run with -u first", file=sys.stderr)
+            sys.exit(255)
+        if db_header(old_db_file_path).get('Digest', DEFAULT_DIGEST) != args.digest:
+            print (f"ficheck: baseline uses {db_header(old_db_file_path).get('Digest', DEFAULT_DIGEST)}, not {args.digest}",
+                   file=sys.stderr)
+            sys.exit(255)
+        rescan = rescan_targets(root_dirs, Exclusions(skip_paths))
+
+    if args.report and not args.stream:
+        report_fd = os.open(report_file_path, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o600)
+        report = os.fdopen(report_fd, 'w+', encoding='utf-8')
+
+    with phase('baseline'):
+        old_entries, old_header = load_baseline(old_db_file_path) if args.incremental else ({}, {})
+        if args.packages:
+            package_index = load_package_index()
+    racy_after = scan_second(old_header)
+    curr_time = datetime.now(timezone.utc).isoformat()
+    if need_full_rehash(old_header):
+        full_hash_time = curr_time
+    else:
+        baseline = old_entries
+        full_hash_time = old_header['Fullhash']
+    if rescan:
+        # rows outside the rescanned subtrees are copied, not rehashed
+        full_hash_time = db_header(old_db_file_path).get('Fullhash')
+
+    # checkpoints need a db written as it goes and a single walk in order
+    resume_point = None
+    if args.checkpoint_interval > 0 and args.db_format == 'text' and not args.parallel_roots and not rescan:
+        checkpoint_path = new_db_file_path + ".checkpoint"
+        checkpoint_state = {'version': 1, 'config': args.config, 'roots': root_dirs,
+                            'digest': args.digest, 'format': args.db_format, 'size': args.size,
+                            'incremental': args.incremental, 'packages': args.packages,
+                            'package_hash': args.package_hash}
+        if args.resume:
+            resume_point = load_checkpoint(checkpoint_state)
+            if resume_point is None:
+                print ("ficheck: no usable checkpoint, starting over", file=sys.stderr)
+            else:
+                restore_checkpoint(resume_point)
+                curr_time = resume_point['creation']
+                full_hash_time = resume_point['fullhash']
+                baseline = {} if full_hash_time == curr_time else old_entries
+        checkpoint_state.update(creation=curr_time, fullhash=full_hash_time)
+        next_checkpoint = time.monotonic() + args.checkpoint_interval
+
+    if resume_point:
+        db_writer = DbWriter(new_db_file_path, args.buffer_size, resume_point['offset'])
+    else:
+        db_writer = open_db_writer(new_db_file_path)
+    if os.name == "posix":
+        sys_info = os.uname()
+    if not resume_point:
+        db_writer.comment(f"# - - Host     {hostname}")
+        db_writer.comment(f"# - - OS       {sys_info.sysname} {sys_info.release}")
+        db_writer.comment(f"# - - Creation {curr_time}")
+        if full_hash_time:
+            db_writer.comment(f"# - - Fullhash {full_hash_time}")
+        db_writer.comment(f"# - - Digest   {args.digest}")
+        db_writer.comment(f"# - - Uname    {sys_info.sysname} {hostname} {sys_info.release} {sys_info.version} {sys_info.machine}")
+        db_writer.comment("# - - Ficheck by Jim Clausing, ideas freely stolen from FCheck perl script by Michael A. Gumienny")
+
+    if not os.path.exists(old_db_file_path) and not args.golden:
         if args.update:
             args.report = False
 
     # Convert skip paths to absolute paths for consistency
-    skip_paths = [os.path.abspath(p) for p in skip_paths]
+    skip_paths = Exclusions(os.path.abspath(p) for p in skip_paths)
 
-    walk_directory_tree(root_dirs, skip_paths)
+    with phase('walk'):
+        if rescan:
+            rescan_db(root_dirs, skip_paths, rescan)
+        else:
+            walk_directory_tree(root_dirs, skip_paths, resume_point)
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+    with phase('write'):
+        db_writer.close()
+        write_tree(new_db_file_path, db_writer.tree)
 
-    compare_files(old_db_file_path, new_db_file_path)
+    with phase('compare'):
+        compare_files(args.golden or old_db_file_path, new_db_file_path)
 
-    if args.update:
-        move_file(old_db_file_path, new_db_file_path)
-    else:
-        os.remove(new_db_file_path)
+    with phase('update'):
+        if args.update:
+            move_file(old_db_file_path, new_db_file_path)
+            move_file(old_db_file_path + TREE_SUFFIX, new_db_file_path + TREE_SUFFIX)
+            # only once the baseline is in place, so a history error can't lose it
+            if args.sqlite:
+                record_scan(sqlite_db_file_path, old_db_file_path, curr_time)
+        else:
+            os.remove(new_db_file_path)
+            os.remove(new_db_file_path + TREE_SUFFIX)
+
+    if args.stats:
+        write_stats()
 
     if args.report:
-        if total_changes > 0:
-            report.flush()
-            report.seek(0)
-            shutil.copyfileobj(report, sys.stdout)
-        report.close()
-        os.remove(report_file_path)
+        if report is not None:
+            if total_changes > 0:
+                report.flush()
+                report.seek(0)
+                shutil.copyfileobj(report, sys.stdout)
+            report.close()
+            os.remove(report_file_path)
         if total_changes > 0:
             sys.exit(1)
@@ -16,13 +16,19 @@ import hashlib
 import base64
 import contextlib
 import codecs
+import errno
+import io
+import mmap
+import queue
 import signal
-from collections import namedtuple
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
 if sys.version_info < (3, 6):
     import sha3  # pylint: disable=import-error,unused-import
 
-__version_info__ = (1, 9, 1)
+__version_info__ = (1, 13, 0)
 __version__ = ".".join(map(str, __version_info__))
 
 # Single source of truth for supported hash algorithms.
@@ -53,7 +59,18 @@ HASH_SPECS = (
     HashSpec("sha3",     "sha3-384", "  SHA3-384: ", hashlib.sha3_384, _hex, 96),
 )
 
+# --thread-per-hash: files at least THREAD_MIN bytes are read in blocks of
+# at least THREAD_BLOCK bytes into a ring of RING_BUFFERS reusable buffers.
+THREAD_MIN = 8 * 1048576
+THREAD_BLOCK = 1048576
+RING_BUFFERS = 4
+# --mmap-min files are hashed through mmap in MMAP_CHUNK slices; --direct
+# needs buffers and read sizes aligned to DIRECT_ALIGN.
+MMAP_CHUNK = 1048576
+DIRECT_ALIGN = 4096
+
 args = None  # pylint: disable=invalid-name
+read_buffers = threading.local()  # pylint: disable=invalid-name
 
 
 @contextlib.contextmanager
@@ -84,25 +101,160 @@ def print_header():
     sys.stdout.flush()
 
 
-def hash_file(fname):  # pylint: disable=redefined-outer-name
-    """Compute selected hashes for fname (or '-' for stdin).
+def aligned_buffer(size):
+    """Return a writable memoryview of size bytes on a page boundary.
+
+    Anonymous mmap memory is page aligned, which O_DIRECT reads need.
+    """
+    return memoryview(mmap.mmap(-1, size))
+
+
+def read_buffer():
+    """Return this thread's reusable -B sized read buffer."""
+    view = getattr(read_buffers, "view", None)
+    if view is None or len(view) != args.block:
+        view = read_buffers.view = aligned_buffer(args.block)
+    return view
+
+
+@contextlib.contextmanager
+def open_for_hashing(fname):
+    """Open fname (or '-' for stdin) for hashing, yielding (file, direct).
+
+    Files are opened unbuffered, since every read goes straight into a
+    preallocated buffer. With --direct, O_DIRECT is tried first; file
+    systems that refuse it (tmpfs, for one) fall back to a normal read.
+    Cached reads are marked sequential and, unless --keep-cache, dropped
+    from the page cache afterwards.
+    """
+    if not fname or fname == "-":
+        yield sys.stdin.buffer, False
+        return
+    fd = None
+    direct = False
+    if args.direct and hasattr(os, "O_DIRECT"):
+        try:
+            fd = os.open(fname, os.O_RDONLY | os.O_DIRECT)
+            direct = True
+        except OSError as err:
+            if err.errno != errno.EINVAL:
+                raise
+    if fd is None:
+        fd = os.open(fname, os.O_RDONLY)
+    advise = not direct and hasattr(os, "posix_fadvise")
+    with io.FileIO(fd, "rb") as f:
+        if advise:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        yield f, direct
+        if advise and not args.keep_cache:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def update_mapped(f, hashes, size):
+    """Feed a file to every hash object through a read-only mmap.
+
+    A file already shorter than the size hash_file() stat'ed cannot be
+    mapped safely, so one whose size has changed is handed to
+    update_sequential() instead.
+    """
+    if os.fstat(f.fileno()).st_size != size:
+        update_sequential(f, hashes)
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+        for offset in range(0, len(view), MMAP_CHUNK):
+            # Slices must be released before the map can be closed.
+            with view[offset:offset + MMAP_CHUNK] as block:
+                for h in hashes.values():
+                    h.update(block)
+
+
+def update_sequential(f, hashes):
+    """Feed f to every hash object, reading into this thread's buffer."""
+    view = read_buffer()
+    while True:
+        count = f.readinto(view)
+        if not count:
+            break
+        block = view[:count]
+        for h in hashes.values():
+            h.update(block)
+
+
+def update_threaded(f, hashes):
+    """Feed the contents of f to every hash object, each in its own thread.
+
+    One reader (the calling thread) fills a ring of reusable buffers with
+    readinto(); every hash object has a worker thread and a queue of filled
+    buffers, and a buffer goes back to the reader once all workers have
+    consumed it. hashlib drops the GIL while hashing, so wall time approaches
+    that of the slowest algorithm rather than the sum of all of them.
+    """
+    views = [aligned_buffer(max(args.block, THREAD_BLOCK)) for _ in range(RING_BUFFERS)]
+    free = queue.Queue()
+    for i in range(RING_BUFFERS):
+        free.put(i)
+    remaining = [0] * RING_BUFFERS
+    lock = threading.Lock()
+    queues = [queue.Queue() for _ in hashes]
+
+    def worker(h, q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            i, count = item
+            h.update(views[i][:count])
+            with lock:
+                remaining[i] -= 1
+                done = remaining[i] == 0
+            if done:
+                free.put(i)
+
+    threads = [threading.Thread(target=worker, args=(h, q), daemon=True)
+               for h, q in zip(hashes.values(), queues)]
+    for t in threads:
+        t.start()
+    try:
+        while True:
+            i = free.get()
+            count = f.readinto(views[i])
+            if not count:
+                break
+            remaining[i] = len(queues)
+            for q in queues:
+                q.put((i, count))
+    finally:
+        for q in queues:
+            q.put(None)
+        for t in threads:
+            t.join()
+
+
+def hash_file(fname, specs=None):  # pylint: disable=redefined-outer-name
+    """Compute selected hashes (or those in specs) for fname (or '-' for stdin).
 
+    Blocks are read into a reused buffer, or with --mmap-min large files
+    are mapped instead, and with -T each algorithm gets its own thread.
     Returns a dict {arg_attr: hash_obj} on success, or None on IO/permission
     error. For regular files, stat() is captured before and after reading;
     a warning is printed to stderr if size or mtime changed mid-read.
     """
-    hashes = {spec.arg_attr: spec.factory() for spec in selected_specs()}
+    hashes = {spec.arg_attr: spec.factory() for spec in specs or selected_specs()}
     stat_before = None
     if fname and fname != "-":
         try:
             stat_before = os.stat(fname)
         except OSError:
             pass
+    size = stat_before.st_size if stat_before is not None else None
     try:
-        with smart_open(fname) as f:
-            for block in iter(lambda: f.read(args.block), b""):
-                for h in hashes.values():
-                    h.update(block)
+        with open_for_hashing(fname) as (f, direct):
+            if args.thread_per_hash and len(hashes) > 1 and (size is None or size >= THREAD_MIN):
+                update_threaded(f, hashes)
+            elif not direct and args.mmap_min and size and size >= args.mmap_min:
+                update_mapped(f, hashes, size)
+            else:
+                update_sequential(f, hashes)
     except (IOError, PermissionError):
         return None
     if stat_before is not None:
@@ -120,6 +272,73 @@ def hash_file(fname):  # pylint: disable=redefined-outer-name
             pass
     return hashes
 
+def iter_targets(paths):
+    """Yield (fname, found) for every file named by paths, in output order.
+
+    Directories are walked with -r; found is False for a path that is
+    neither a file nor stdin, so the caller can report it in sequence.
+    """
+    for path in paths:
+        if os.path.isdir(os.path.abspath(path)) and args.recursive:
+            if args.fullpath:
+                path = os.path.abspath(path)
+            for root, _, filenames in os.walk(path):
+                for filename in filenames:
+                    fname = os.path.join(root, filename)
+                    if os.path.isfile(fname):
+                        yield fname, True
+        elif os.path.isfile(path) or path == "-":
+            yield path, True
+        else:
+            yield path, False
+
+
+def hashed_files(targets, wanted=None):
+    """Yield (fname, found, hashes) for each target, hashing -j files at a time.
+
+    With a single job this is the plain sequential loop. Otherwise files are
+    hashed in a thread pool (file reads and hashlib both release the GIL) with
+    at most a few batches of jobs outstanding. Results come out in target
+    order, or as each file finishes with --unordered. wanted maps fname to
+    the specs to compute for it, instead of the selected ones.
+    """
+
+    def run(fname):
+        return hash_file(fname, wanted[fname] if wanted else None)
+
+    if args.jobs == 1:
+        for fname, found in targets:
+            yield fname, found, run(fname) if found else None
+        return
+    window = args.jobs * 4
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        if args.unordered:
+            running = {}
+            for fname, found in targets:
+                if not found:
+                    yield fname, False, None
+                    continue
+                running[pool.submit(run, fname)] = fname
+                if len(running) >= window:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield running.pop(future), True, future.result()
+            for future in as_completed(running):
+                yield running[future], True, future.result()
+            return
+        pending = deque()
+        for fname, found in targets:
+            pending.append((fname, found, pool.submit(run, fname) if found else None))
+            # a missing file at the head has nothing to wait for
+            while len(pending) > window or (
+                    pending and (pending[0][2] is None or pending[0][2].done())):
+                fname, found, future = pending.popleft()
+                yield fname, found, future.result() if future else None
+        while pending:
+            fname, found, future = pending.popleft()
+            yield fname, found, future.result() if future else None
+
+
 def print_hashes(fname, hashes):  # pylint: disable=redefined-outer-name
     """Print computed hashes for fname in the selected output format.
 
@@ -152,53 +371,115 @@ def count_hashes():
     """Return how many hash types are selected."""
     return len(selected_specs())
 
-def check_hashes():
-    """Read hash-file(s) from args.files and verify each listed file.
+def read_manifest(fpath):
+    """Yield (path, spec, digest) for each usable line of one hash file.
 
     Algorithm is inferred from digest length. Lengths are unambiguous within
     the set this script supports; SHA3-256/SHA3-512 are not supported, so
     SHA3-224 (56) and SHA3-384 (96) are the only SHA3 variants in play.
     """
-    failures = 0
-    for fpath in args.files:
+    with smart_open(fpath) as f:
+        for line in f:
+            try:
+                line = line.decode('utf-8')
+            except UnicodeDecodeError as exc:
+                print(
+                    f"{sys.argv[0]}: skipping line with encoding error: {exc}",
+                    file=sys.stderr,
+                )
+                continue
+            line = line.strip('\n')
+            parts = str(line).split("  ")
+            if len(parts) < 2 or not parts[1].strip():
+                continue
+            spec = next(
+                (s for s in HASH_SPECS if s.digest_len == len(parts[0])),
+                None,
+            )
+            if spec is not None:
+                yield parts[1], spec, parts[0]
+
+
+def group_manifests(paths):
+    """Parse the hash files in paths; return (entries, wanted).
+
+    entries lists (path, spec, digest) in manifest order, and wanted maps
+    each path to the specs its lines need, so it can be hashed once.
+    """
+    entries = []
+    wanted = {}
+    for fpath in paths:
         if os.path.isfile(fpath) or fpath == "-":
-            with smart_open(fpath) as f:
-                for line in f:
-                    try:
-                        line = line.decode('utf-8')
-                    except UnicodeDecodeError as exc:
-                        print(
-                            f"{sys.argv[0]}: skipping line with encoding error: {exc}",
-                            file=sys.stderr,
-                        )
-                        continue
-                    line = line.strip('\n')
-                    parts = str(line).split("  ")
-                    if len(parts) < 2 or not parts[1].strip():
-                        continue
-                    spec = next(
-                        (s for s in HASH_SPECS if s.digest_len == len(parts[0])),
-                        None,
-                    )
-                    if spec is None:
-                        continue
-                    if not os.path.isfile(parts[1]):
-                        print(parts[1], ": File not found")
-                        failures += 1
-                        continue
-                    setattr(args, spec.arg_attr, True)
-                    hashes = hash_file(parts[1])
-                    if hashes is None or parts[0] != spec.format_fn(hashes[spec.arg_attr]):
-                        print(parts[1] + ": FAILED")
-                        failures += 1
-                    else:
-                        print(parts[1] + ": OK")
-        sys.stdout.flush()
+            for path, spec, digest in read_manifest(fpath):
+                entries.append((path, spec, digest))
+                specs = wanted.setdefault(path, [])
+                if spec not in specs:
+                    specs.append(spec)
+    return entries, wanted
+
+
+def verify_entries(entries, wanted):
+    """Hash every wanted file, printing OK/FAILED per entry; return the failures.
+
+    Each entry is printed as soon as its file, and those of all the entries
+    before it, are done, so the output follows the manifest order.
+    """
+    failures = 0
+    digests = {}
+    printed = 0
+    targets = ((path, os.path.isfile(path)) for path in wanted)
+    for path, found, hashes in hashed_files(targets, wanted):
+        if not found:
+            digests[path] = False
+        elif hashes is None:
+            digests[path] = None
+        else:
+            digests[path] = {spec.arg_attr: spec.format_fn(hashes[spec.arg_attr])
+                             for spec in wanted[path]}
+        while printed < len(entries) and entries[printed][0] in digests:
+            path, spec, digest = entries[printed]
+            result = digests[path]
+            printed += 1
+            if result is False:
+                print(path, ": File not found")
+                failures += 1
+            elif result is None or digest != result[spec.arg_attr]:
+                print(path + ": FAILED")
+                failures += 1
+            else:
+                print(path + ": OK")
+    return failures
+
+
+def check_hashes():
+    """Read hash-file(s) from args.files and verify each listed file.
+
+    The manifests are parsed up front and their lines grouped by path, so
+    a file listed under several algorithms is read once, computing every
+    digest it needs. Files are hashed -j at a time; OK/FAILED lines come
+    out in manifest order.
+    """
+    failures = verify_entries(*group_manifests(args.files))
+    sys.stdout.flush()
     if failures > 0:
         print(sys.argv[0] + ": WARNING: " + str(failures) + " checksums did not match")
         sys.exit(255)
 
 
+def hash_targets(paths):
+    """Hash and print every file named by paths; return True if any failed."""
+    had_error = False
+    for fname, found, result in hashed_files(iter_targets(paths)):
+        if not found:
+            print(f"{sys.argv[0]}: {fname}: No such file or directory", file=sys.stderr)
+            had_error = True
+            continue
+        if result is None:
+            had_error = True
+        print_hashes(fname, result)
+    return had_error
+
+
 if __name__ == "__main__":
     # restore default SIGPIPE behavior so piping to head/less doesn't traceback
     if hasattr(signal, "SIGPIPE"):
@@ -246,6 +527,19 @@ if __name__ == "__main__":
         "-B", "--block", metavar="blk", type=int, default=65536,
         help="block size to read file, default = 65536"
     )
+    parser.add_argument(
+        "--mmap-min", metavar="BYTES", type=int, default=0,
+        help="hash files of at least BYTES through mmap instead of reading them, "
+        "default = 0 (never)"
+    )
+    parser.add_argument(
+        "--direct", action="store_true",
+        help="read with O_DIRECT, bypassing the page cache (block size is rounded up to 4096)"
+    )
+    parser.add_argument(
+        "--keep-cache", action="store_true",
+        help="don't drop hashed files from the page cache afterwards"
+    )
     parser.add_argument(
         "-c", "--check", action="store_true", help="read sums from FILE and check them"
     )
@@ -254,10 +548,26 @@ if __name__ == "__main__":
     parser.add_argument(
         "-p", "--psv", action="store_true", help="write output as pipe separated values"
     )
+    parser.add_argument(
+        "-j", "--jobs", metavar="N", type=int, default=1,
+        help="number of files to hash at once, default = 1"
+    )
+    parser.add_argument(
+        "-T", "--thread-per-hash", action="store_true",
+        help="hash each algorithm in its own thread for files of 8 MB or more (speeds up -a)"
+    )
+    parser.add_argument(
+        "-u", "--unordered", action="store_true",
+        help="with -j, print each file as soon as it is hashed instead of in walk order"
+    )
     args = parser.parse_args()
 
     if args.block <= 0:
         parser.error("block size must be > 0")
+    if args.jobs <= 0:
+        parser.error("jobs must be > 0")
+    if args.direct:
+        args.block = -(-args.block // DIRECT_ALIGN) * DIRECT_ALIGN
 
     # default to --all only when no specific hash switch and not in check mode
     any_hash = args.md5 or args.sha1 or args.sha256 or args.sha3 or args.sha3_224 or args.sha512
@@ -277,28 +587,4 @@ if __name__ == "__main__":
         sys.exit(0)
 
     # process commandline arguments
-    # pylint: disable=invalid-name
-    had_error = False
-    for path in args.files:
-        if os.path.isdir(os.path.abspath(path)) and args.recursive:
-            if args.fullpath:
-                path = os.path.abspath(path)
-            for root, directories, filenames in os.walk(path):
-                for filename in filenames:
-                    fname = os.path.join(root, filename)
-                    if os.path.isfile(fname):
-                        result = hash_file(fname)
-                        if result is None:
-                            had_error = True
-                        print_hashes(fname, result)
-        else:
-            if os.path.isfile(path) or path == "-":
-                result = hash_file(path)
-                if result is None:
-                    had_error = True
-                print_hashes(path, result)
-            else:
-                print(f"{sys.argv[0]}: {path}: No such file or directory", file=sys.stderr)
-                had_error = True
-
-    sys.exit(1 if had_error else 0)
+    sys.exit(1 if hash_targets(args.files) else 0)
@@ -0,0 +1,182 @@
+"""Regression tests for ficheck.py, run against a scratch tree."""
+
+import argparse
+import io
+import os
+import socket
+import subprocess
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FICHECK = os.path.join(REPO, "ficheck.py")
+sys.path.insert(0, REPO)
+import ficheck  # pylint: disable=wrong-import-position
+
+
+def run_ficheck(tmp_path, *options):
+    """Run ficheck.py with the scratch config and dbs, returning the result"""
+    command = [sys.executable, FICHECK, "-c", str(tmp_path / "cfg"),
+               "--db", str(tmp_path / "db"), "--new-db", str(tmp_path / "new"),
+               "--report-file", str(tmp_path / "report"), *options]
+    return subprocess.run(command, capture_output=True, text=True, check=False)
+
+
+def make_root(tmp_path, name):
+    """Create a small tree under tmp_path/name and a config watching it"""
+    root = tmp_path / name
+    (root / "sub").mkdir(parents=True)
+    (root / "f1").write_text("one\n")
+    (root / "sub" / "f2").write_text("two\n")
+    (tmp_path / "cfg").write_text(f"Directory = {root}/\n")
+    return root
+
+
+def test_hyphenated_root_with_tree(tmp_path):
+    """A root with a hyphen in it is compared the same with or without the .tree sidecar"""
+    root = make_root(tmp_path, "my-root")
+    assert run_ficheck(tmp_path, "-u").returncode == 0
+    assert (tmp_path / "db.tree").exists()
+    (root / "f1").write_text("changed\n")
+    (root / "sub" / "f3").write_text("three\n")
+
+    with_tree = run_ficheck(tmp_path, "-r")
+    os.remove(tmp_path / "db.tree")
+    without_tree = run_ficheck(tmp_path, "-r")
+
+    assert with_tree.returncode == without_tree.returncode == 1
+    assert with_tree.stdout == without_tree.stdout
+    assert f"WARNING: [{socket.gethostname()}] {root}/f1" in with_tree.stdout
+    assert f"{root}/sub/f3" in with_tree.stdout
+
+
+def test_rescan_hyphenated_and_new_root(tmp_path):
+    """--only works under a hyphenated root and --root scans a newly configured one"""
+    root = make_root(tmp_path, "my-root")
+    assert run_ficheck(tmp_path, "-u").returncode == 0
+    (root / "sub" / "f2").write_text("changed\n")
+    assert run_ficheck(tmp_path, "-u", "--only", str(root / "sub")).returncode == 0
+    db = (tmp_path / "db").read_text()
+    assert f"#-----------------BEGIN DIRECTORY {root}--------------------\n" in db
+    row = next(line for line in db.splitlines() if line.startswith(f"{root}/sub/f2&"))
+    assert row.split("&")[6] == "8"
+
+    added = tmp_path / "new-root"
+    added.mkdir()
+    (added / "f4").write_text("four\n")
+    with open(tmp_path / "cfg", "a", encoding="utf8") as cfg:
+        cfg.write(f"Directory = {added}/\n")
+    assert run_ficheck(tmp_path, "-u", "--root", str(added)).returncode == 0
+    db = (tmp_path / "db").read_text()
+    assert f"#-----------------BEGIN DIRECTORY {added}--------------------\n" in db
+    assert f"{added}/f4&" in db
+    assert f"{root}/f1&" in db
+
+    missing = run_ficheck(tmp_path, "-u", "--root", str(tmp_path / "elsewhere"))
+    assert missing.returncode == 255
+
+
+def test_sqlite_history_overlapping_roots(tmp_path):
+    """--sqlite records a path once when Directory roots overlap, in a 0600 store"""
+    root = make_root(tmp_path, "root")
+    with open(tmp_path / "cfg", "a", encoding="utf8") as cfg:
+        cfg.write(f"Directory = {root}/sub/\n")
+    store = tmp_path / "history.sqlite"
+    assert run_ficheck(tmp_path, "-u", "--sqlite", "--sqlite-db", str(store)).returncode == 0
+    (root / "sub" / "f2").write_text("changed\n")
+    assert run_ficheck(tmp_path, "-u", "--sqlite", "--sqlite-db", str(store)).returncode == 0
+    assert os.stat(store).st_mode & 0o777 == 0o600
+
+    history = run_ficheck(tmp_path, "--sqlite-db", str(store), "--history", str(root / "sub" / "f2"))
+    states = [line.split("&")[1] for line in history.stdout.splitlines()]
+    assert states == ["baseline", "modified"]
+
+
+def test_golden_reports_directory_chown(tmp_path):
+    """With ctime and mtime masked, a directory uid/gid change against --golden is reported"""
+    root = make_root(tmp_path, "root")
+    assert run_ficheck(tmp_path, "-u").returncode == 0
+    golden = tmp_path / "golden.db"
+    lines = (tmp_path / "db").read_text().splitlines(keepends=True)
+    with open(golden, "w", encoding="utf8") as out:
+        for line in lines:
+            fields = line.split("&")
+            if fields[0] == f"{root}/sub":
+                fields[4:6] = [str(os.getuid() + 1), str(os.getgid() + 1)]
+            out.write("&".join(fields))
+
+    result = run_ficheck(tmp_path, "-r", "--golden", str(golden))
+    assert result.returncode == 1
+    assert f"{root}/sub\n" in result.stdout
+
+
+class FakeInotify:
+    """Records watches instead of creating them"""
+
+    def __init__(self):
+        self.watched = []
+
+    def add_watch(self, path):
+        """Remember path"""
+        self.watched.append(path)
+
+
+def test_monitor_hashes_nested_move_once(tmp_path, monkeypatch):
+    """A directory tree moved into a watched root is walked and hashed once"""
+    root = tmp_path / "root"
+    root.mkdir()
+    chain = tmp_path / "chain"
+    level = chain
+    for depth in range(6):
+        level.mkdir()
+        (level / f"file{depth}").write_text(f"{depth}\n")
+        level = level / "next"
+    monkeypatch.setattr(ficheck, "args", argparse.Namespace(
+        digest="sha256", size=500000000, mmap_threshold=0, keep_cache=False, package_hash=False,
+        stats=False, stats_top=0, max_rate=0, max_load=0, format="json"))
+    monkeypatch.setattr(ficheck, "files_hashed", 0)
+    monitor = ficheck.Monitor([str(root)], ficheck.Exclusions([]), {}, io.StringIO())
+    monitor.inotify = FakeInotify()
+
+    os.rename(chain, root / "chain")
+    monitor.check_path(str(root / "chain"))
+
+    assert ficheck.files_hashed == 6
+    assert len(monitor.inotify.watched) == 6
+    assert len(monitor.entries) == 12
+
+
+def test_incremental_rehashes_same_second_rewrite(tmp_path):
+    """-i rehashes a same-size rewrite made in the second the baseline scan started"""
+    root = make_root(tmp_path, "root")
+    (root / "f1").write_text("AAAA\n")
+    assert run_ficheck(tmp_path, "-u").returncode == 0
+    (root / "f1").write_text("BBBB\n")
+
+    result = run_ficheck(tmp_path, "-r", "-i")
+    assert result.returncode == 1
+    assert f"{root}/f1" in result.stdout
+
+
+def test_rescan_keeps_fullhash(tmp_path):
+    """A partial rescan carries the old Fullhash forward instead of resetting it"""
+
+    def fullhash():
+        return [line for line in (tmp_path / "db").read_text().splitlines()
+                if line.startswith("# - - Fullhash")]
+
+    root = make_root(tmp_path, "root")
+    assert run_ficheck(tmp_path, "-u").returncode == 0
+    before = fullhash()
+    assert run_ficheck(tmp_path, "-u", "--only", str(root / "sub")).returncode == 0
+    assert fullhash() == before
+
+
+def test_tree_written_during_scan_matches_rebuild(tmp_path):
+    """The digests collected while writing the db equal those rebuilt by reading it"""
+    root = make_root(tmp_path, "root")
+    (root / "sub" / 'odd & "quoted"').write_text("odd\n")
+    for db_format in ("text", "binary"):
+        assert run_ficheck(tmp_path, "-u", "--db-format", db_format).returncode == 0
+        written = (tmp_path / "db.tree").read_text()
+        ficheck.write_tree(str(tmp_path / "db"))
+        assert (tmp_path / "db.tree").read_text() == written